@@ -19,9 +19,333 @@ import numpy as np
 import rasterio
 import geopandas as gpd
 import json
-from rasterio.mask import mask
-from glob import glob
+import os
+import functools
 import h5py as h5
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+
+import NDVI_Normalisation
+import NDVI_cube
+import raster_io
+import zonal_statistics
+
+
+# Number of dekads in the VCI3M, three months.
+VCI3M_WINDOW = 9
+
+
+def rolling_VCI3M(VCI,previous=None,window=VCI3M_WINDOW):
+    """Mean VCI over the last three months of each date, ignoring NaN.
+    
+    The VCI3M of a date is the mean of the VCI of that date and of the
+    window-1 dates before it that are not NaN. For the first window-1 dates
+    of a time series it is the mean of every date so far. If all the VCI in
+    the window is NaN then so is the VCI3M. The sums and counts of each
+    window come from cumulative sums, so every shape and date is done at
+    once.
+    
+    Parameters
+    ----------
+    VCI : :obj:`NumPy array` of :obj:`float`
+        VCI with the dates along the last axis.
+    previous : :obj:`NumPy array` of :obj:`float`
+        VCI of the dates just before, up to window-1 of them, when only the
+        VCI3M of the end of a time series is wanted.
+    window : int
+        Number of dates in each mean.
+        
+    Returns
+    -------
+    :obj:`NumPy array` of :obj:`float`
+        The VCI3M, the same shape as VCI.
+    
+    """
+    VCI = np.asarray(VCI,dtype='float')
+    
+    skip = 0
+    if previous is not None and window > 1:
+        previous = np.asarray(previous,dtype='float')[...,-(window-1):]
+        skip = previous.shape[-1]
+        VCI = np.concatenate([previous,VCI],axis=-1)
+    
+    valid = ~np.isnan(VCI)
+    zeros = np.zeros(VCI.shape[:-1]+(1,))
+    sums = np.concatenate([zeros,np.cumsum(np.where(valid,VCI,0),axis=-1)],
+                          axis=-1)
+    counts = np.concatenate([zeros,np.cumsum(valid,axis=-1)],axis=-1)
+    
+    ends = np.arange(1,VCI.shape[-1]+1)
+    starts = np.maximum(ends-window,0)
+    window_counts = counts[...,ends]-counts[...,starts]
+    
+    with np.errstate(divide='ignore',invalid='ignore'):
+        VCI3M = (sums[...,ends]-sums[...,starts])/window_counts
+    VCI3M[window_counts == 0] = np.nan
+    
+    return VCI3M[...,skip:]
+
+
+def aggregate_layers(time_series):
+    """Aggregate the time series of several shapefiles together.
+    
+    Time series of the same NDVI files are aggregated in one pass, so each
+    date and the min/max of each dekad are read once for all of them
+    however many shapefiles there are. Each still writes its own database.
+    
+    Parameters
+    ----------
+    time_series : :obj:`List` of :obj:`aggregate_time_series`
+        The time series to aggregate, not yet run. The settings of the first
+        of each group, such as the cube and workers, are used for the group.
+        
+    Returns
+    -------
+    None.
+    
+    """
+    groups = {}
+    for series in time_series:
+        groups.setdefault(tuple(series.NDVI_files),[]).append(series)
+        
+    for group in groups.values():
+        group[0].open_files(group[1:])
+
+
+def roll_up(sums_file,parents):
+    """Time series of parent zones from the saved sums of their children.
+    
+    The sums and pixel counts of the children of each parent are added up
+    and the means found from them as for any other zone, so no rasters are
+    read. A parent is under cloud if under 1% of the pixels of the window
+    around all of its children have NDVI. Where the children don't overlap,
+    as with the counties of a country, this is the same as aggregating the
+    parent itself.
+    
+    Parameters
+    ----------
+    sums_file : str
+        Filepath to the <database>_sums.h5 file of the children.
+    parents : dict
+        The name of the parent of each child. Children not in it are left
+        out.
+        
+    Returns
+    -------
+    dict
+        For each parent, an array of the date, NDVI, VCI and VCI3M of each
+        date, the same as the datasets of a database.
+    
+    """
+    with h5.File(sums_file,'r') as storage_file:
+        children = [name.decode() for name in storage_file['Zones'][:]]
+        dates = storage_file['Dates'][:]
+        windows = storage_file['Windows'][:]
+        sums = {name:storage_file[name][:] for name in
+                zonal_statistics.SUM_NAMES}
+    
+    parent_names = []
+    for child in children:
+        if child in parents and parents[child] not in parent_names:
+            parent_names.append(parents[child])
+    
+    rows = [counter for counter,child in enumerate(children)
+            if child in parents]
+    labels = np.array([parent_names.index(parents[children[counter]])
+                       for counter in rows],dtype='int64')
+    
+    parent_sums = {}
+    for name in zonal_statistics.SUM_NAMES:
+        parent_sums[name] = np.zeros((len(parent_names),len(dates)))
+        np.add.at(parent_sums[name],labels,sums[name][rows])
+    
+    # The window around all the children of each parent
+    windows = windows[rows]
+    top = np.full(len(parent_names),np.iinfo('int64').max)
+    left = top.copy()
+    bottom = np.full(len(parent_names),np.iinfo('int64').min)
+    right = bottom.copy()
+    np.minimum.at(top,labels,windows[:,0])
+    np.minimum.at(left,labels,windows[:,1])
+    np.maximum.at(bottom,labels,windows[:,0]+windows[:,2])
+    np.maximum.at(right,labels,windows[:,1]+windows[:,3])
+    
+    NDVI,VCI = zonal_statistics.means_from_sums(parent_sums,
+                                                (bottom-top)*(right-left))
+    VCI3M = rolling_VCI3M(VCI)
+    
+    return {parent:np.stack([dates.astype('float'),NDVI[counter],
+                             VCI[counter],VCI3M[counter]],axis=1)
+            for counter,parent in enumerate(parent_names)}
+
+
+# Number of recent polygon queries whose time series are kept in memory.
+QUERY_CACHE_SIZE = 32
+
+
+def query_polygon(geojson,
+                  cube_filepath='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Cubes\\Smoothed_NDVI.h5',
+                  crs='EPSG:4326'):
+    """Time series of any polygon, without a shapefile or a database.
+    
+    Only the window around the polygon is read, every date at once from the
+    cube of the smoothed NDVI, whose chunks are a few dekads deep, and all
+    of the min/max from the climatology store. The NDVI and VCI are then
+    found with the same zone engine and cloud rules as the aggregation. The
+    last QUERY_CACHE_SIZE queries are kept, so asking again is instant
+    until the cube or the climatology change.
+    
+    Parameters
+    ----------
+    geojson : dict or str
+        A GeoJSON geometry, Feature or FeatureCollection. Every polygon in
+        it is taken together as one area.
+    cube_filepath : str
+        Filepath to the cube of the smoothed NDVI.
+    crs : str
+        The crs of the GeoJSON.
+        
+    Returns
+    -------
+    :obj:`NumPy array` of :obj:`float`
+        The date, NDVI, VCI and VCI3M of each date in the cube, the same as
+        the datasets of a database.
+    
+    """
+    if not isinstance(geojson,str):
+        geojson = json.dumps(geojson,sort_keys=True)
+    
+    store_file = NDVI_Normalisation.climatology_store()
+    
+    return cached_query(geojson,crs,cube_filepath,
+                        os.path.getmtime(cube_filepath),store_file,
+                        os.path.getmtime(store_file)).copy()
+
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def cached_query(geojson,crs,cube_filepath,cube_modified,store_file,
+                 store_modified):
+    """The query of query_polygon, cached on its arguments.
+    
+    The modification times of the cube and store are only part of the key,
+    so that a query is found again once either of them has changed.
+    """
+    geojson = json.loads(geojson)
+    
+    if geojson['type'] == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in geojson['features']]
+    elif geojson['type'] == 'Feature':
+        geometries = [geojson['geometry']]
+    else:
+        geometries = [geojson]
+    
+    with rasterio.open(store_file) as store:
+        
+        geometries = [transform_geom(crs,store.crs,geometry) for geometry
+                      in geometries]
+        
+        (row_off,col_off,height,width),zones = \
+            zonal_statistics.zone_engine.from_geometries([geometries],
+                                                         store).cropped()
+        
+        # Bands 1 to 36 are the min and 37 to 72 the max of each dekad
+        min_max = store.read(window=Window(col_off,row_off,width,height))
+        min_max = min_max.reshape(len(min_max),-1)[:,zones.pixels]
+    
+    cube = NDVI_cube.NDVI_cube(cube_filepath)
+    try:
+        dates = np.sort(cube.dates)
+        NDVI = cube.read_window(cube.date_indices(dates),col_off,row_off,
+                                width,height)
+    finally:
+        cube.close()
+    
+    time_series = np.empty((len(dates),4),dtype='float')
+    time_series[:,0] = dates
+    
+    for counter,date in enumerate(dates):
+        
+        dekad = NDVI_Normalisation.DEKADS.index('%04d'%(date%10000))
+        
+        NDVI_mean,VCI = zones.zone_means(
+            zones.zone_sums(zones.gather(NDVI[counter]),min_max[dekad],
+                            min_max[dekad+36]))
+        
+        time_series[counter,1:3] = NDVI_mean[0],VCI[0]
+    
+    time_series[:,3] = rolling_VCI3M(time_series[:,2])
+    
+    return time_series
+
+
+# Each worker process keeps the zones, its own min/max cache and the open
+# climatology store for the whole run, so they are sent and opened once per
+# worker rather than once per dekad.
+worker_state = None
+
+
+def start_worker(zones,store_file,cube,min_max_cache_bytes,gdal_cache_mb):
+    
+    global worker_state
+    
+    environment = rasterio.Env(GDAL_CACHEMAX=gdal_cache_mb)
+    environment.__enter__()
+    
+    climatology = rasterio.open(store_file)
+    
+    worker_state = {'environment':environment,'zones':zones,'cube':cube,
+                    'min_max':zonal_statistics.min_max_cache(
+                        climatology,zones,min_max_cache_bytes)}
+
+
+def aggregate_dates(NDVI_files,date_counters):
+    """Sums of NDVI and VCI over every shape for a chunk of dates, in a worker.
+    
+    Parameters
+    ----------
+    NDVI_files : :obj:`List` of :obj:`str`
+        Filepaths of the dates in the chunk.
+    date_counters : :obj:`List` of :obj:`int`
+        Place of each date in the final array.
+        
+    Returns
+    -------
+    :obj:`List` of :obj:`int`
+        The date_counters, unchanged.
+    :obj:`List` of :obj:`str`
+        The unformatted date of each file.
+    :obj:`NumPy array` of :obj:`float`
+        The sums and counts of every shape for each date, with shape
+        (dates, sums, shapes) and the sums in the order of
+        zonal_statistics.SUM_NAMES.
+    
+    """
+    zones = worker_state['zones']
+    cube = worker_state['cube']
+    
+    dates = []
+    rows = np.empty((len(NDVI_files),len(zonal_statistics.SUM_NAMES),
+                     len(zones)),dtype='float')
+    
+    for counter,NDVI_file in enumerate(NDVI_files):
+        
+        date = NDVI_file.split('\\')[-1].split('.tif')[0]
+        dates.append(date)
+        
+        if cube is not None:
+            raw_NDVI = cube.read_date(int(date[8:]))
+        else:
+            with rasterio.open(NDVI_file) as dataset:
+                raw_NDVI = dataset.read(1)
+        
+        Min,Max = worker_state['min_max'][date[12:]]
+        
+        sums = zones.zone_sums(raw_NDVI,Min,Max)
+        
+        rows[counter] = [sums[name] for name in zonal_statistics.SUM_NAMES]
+        
+    return date_counters,dates,rows
 
 
 
@@ -41,45 +365,57 @@ class aggregate_time_series:
         Filepath to the shapefile that is to be used
     new : bool
         Whether or not a new time series is to be created
+    cube : :obj:`NDVI_cube.NDVI_cube`
+        Optional cube of the smoothed NDVI that the data is read from.
+    zone_cache_file : str
+        Filepath to the cache of the rasterized shapes.
     shapefile_data : :obj:`Geopandas dataframe` of :obj:`object`
-        Shapefile data is read in and converted to the same scale as the tif
-        images.
+        Shapefile data as it is read in. It is only converted to the same
+        scale as the tif images when the shapes have to be rasterized again.
     datasets : :obj:`List` of :obj:`str`
         List of the names of each shape. This is so that when the data is saved
         to the database, each dataset is created with its name.
     final_array : :obj:`NumPy array` of :obj:`float`
         This array contains, for each shape, the date and the mean NDVI,VCI
         and VCI3M over the specified areal.
+    final_sums : dict
+        The sums and pixel counts the means are found from, see
+        zonal_statistics.zone_engine.zone_sums, each with shape (shapes,
+        dates). These are saved next to the database so coarser zones can be
+        rolled up from them without reading the rasters, see roll_up.
+    zones : :obj:`zonal_statistics.zone_engine`
+        The pixels of every shape on the NDVI grid, rasterized once per run.
+    layers : :obj:`List` of :obj:`aggregate_time_series`
+        Every time series aggregated in the same pass, this one first.
+    pass_zones : :obj:`zonal_statistics.zone_engine`
+        The zones of every layer one after another. This is zones itself
+        when there is only the one layer.
+    climatology : :obj:`rasterio dataset`
+        The open climatology store holding the min/max of every dekad.
+    min_max : :obj:`zonal_statistics.min_max_cache`
+        The min and max of each dekad at the pixels of every shape, read from
+        the climatology store as they are needed.
     raw_NDVI : :obj:`NumPy array` of :obj:`float`
-        NumPy array of the raw NDVI read in from the file by rasterio
-    raw_VCI : :obj:`NumPy array` of :obj:`float`
-        NumPy array of the raw VCI read in from the file by rasterio
-    raw_VCI3M : :obj:`NumPy array` of :obj:`float`
-        NumPy array of the raw VCI3M read in from the file by rasterio
-    NDVI : :obj:`NumPy array` of :obj:`float`
-        NumPy array of the cropped NDVI
-    VCI : :obj:`NumPy array` of :obj:`float`
-        NumPy array of the cropped VCI
-    VCI3M: :obj:`NumPy array` of :obj:`float`
-        NumPy array of the cropped VCI3M
+        NumPy array of the NDVI image of the date being aggregated
+    zone_sums : dict
+        Sums and counts of NDVI and VCI over every shape of pass_zones for the
+        date, see zonal_statistics.zone_engine.zone_sums
     final_NDVI : :obj:`NumPy array` of :obj:`float`
-        The final NumPy masked array of the cropped NDVI after cloud coverage
-        etc has been taken out.
+        The mean NDVI of every shape of pass_zones after cloud coverage etc
+        has been taken out.
     final_VCI : :obj:`NumPy array` of :obj:`float`
-        The final NumPy masked array of the cropped VCI after cloud coverage
-        etc has been taken out.
-    final_VCI3M : :obj:`NumPy array` of :obj:`float`
-        The final NumPy masked array of the cropped VCI3M after cloud coverage
-        etc has been taken out.
+        The mean VCI of every shape of pass_zones after cloud coverage etc
+        has been taken out.
     date : str 
         Unformatted date %Y%m%d E.g 20090921
     date_counter : int 
         Simple loop counter. Helps with storage of data in arrays
-    shape_counter : int
-        Simple loop conuter, aids with sotrage of data in arrays
     
     """
-    def __init__(self,NDVI_files,shape_file_path,new,name_of_shapefile_column):
+    def __init__(self,NDVI_files,shape_file_path,new,name_of_shapefile_column,
+                 cube=None,min_max_cache_bytes=2*1024**3,workers=1,
+                 gdal_cache_mb=256,
+                 zone_cache_filepath='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Zone_cache'):
         """Defining some attributes.
         
         The sole purpose of __init__ is to initialize values that will be
@@ -97,6 +433,21 @@ class aggregate_time_series:
         name_of_shapefile_column : str
             The column of the shapefile that will be used. E.g name of each 
             county or the region ID. 
+        cube : :obj:`NDVI_cube.NDVI_cube`
+            Cube of the smoothed NDVI. If given, the data for each file is read
+            from the cube instead of the tif itself.
+        min_max_cache_bytes : int
+            Most memory in bytes used to keep the min and max of each dekad
+            at the pixels of the shapes, so they are read once per run. With
+            more than one worker each worker may use this much.
+        workers : int
+            Number of processes the dates are aggregated in. Each worker
+            takes the dates of one dekad at a time.
+        gdal_cache_mb : int
+            Size of the GDAL block cache of each worker in MB.
+        zone_cache_filepath : str
+            Folder the rasterized shapes of each shapefile are cached in. The
+            cache is made again if the shapefile or the NDVI grid changes.
         
         Note
         ---- 
@@ -107,10 +458,16 @@ class aggregate_time_series:
         self.NDVI_files = NDVI_files
         self.shapefile_path = shape_file_path
         self.new = new
+        self.cube = cube
+        self.min_max_cache_bytes = min_max_cache_bytes
+        self.workers = workers
+        self.gdal_cache_mb = gdal_cache_mb
         
+        self.zone_cache_file = (zone_cache_filepath+'\\'+
+                                shape_file_path.split('.shp')[0].split('\\')[-1]
+                                +'_zones.npz')
         
-        self.shapefile_data = gpd.read_file(shape_file_path).to_crs(
-                              crs=rasterio.open(self.NDVI_files[0]).crs.data)
+        self.shapefile_data = gpd.read_file(shape_file_path)
         
         self.datasets = [slash.replace('/', '-') for slash in
                          self.shapefile_data[str(name_of_shapefile_column)].
@@ -120,146 +477,234 @@ class aggregate_time_series:
                                      4),dtype='float')
         
         
+        self.final_sums = {name:np.zeros((len(self.datasets),
+                                          len(self.NDVI_files)))
+                           for name in zonal_statistics.SUM_NAMES}
+        
+        self.zones = None
+        self.layers = None
+        self.pass_zones = None
+        self.climatology = None
         self.raw_NDVI = None
-        self.raw_VCI = None
-        self.raw_VCI3M = None
-        self.NDVI = None
-        self.VCI = None
-        self.VCI3M = None
+        self.min_max = None
+        self.zone_sums = None
         self.final_NDVI = None
         self.final_VCI = None
-        self.final_VCI3M = None
         self.date = None
         self.date_counter = None
-        self.shape_counter = None
         
         
 
         
     
-    @staticmethod
-    def get_features(unformatted_features):
-        """ Function to grab features of shapes from shapefile
+    def zone_geometries(self,crs):
+        """ The geometry of every shape in the crs of the tif images.
+        
+        The whole shapefile is reprojected and converted to GeoJSON at once,
+        this is only needed when the cached shapes can't be used.
         
         Parameters
         ----------
-        unformatted_features : :obj:`list` of :obj:`float`
-            Data about the size/edges of the shape in the shapefile
+        crs : :obj:`rasterio crs`
+            The crs of the tif images.
             
         Returns
         -------
-        Features and geomerty of shapefile
+        :obj:`list` of :obj:`list` of :obj:`dict`
+            The features and geometry of each shape.
         
         """
-        return [json.loads(unformatted_features.to_json())
-                ['features'][0]['geometry']]
+        shapes = self.shapefile_data.to_crs(crs=crs.data)
+        
+        return [[feature['geometry']] for feature in
+                shapes.__geo_interface__['features']]
         
     
-    def open_files(self):
-        """Use rasterio to open each of the NDVI,VCI and VCI3M tifs.
+    def load_zones(self):
+        """Rasterize the shapes onto the NDVI grid, or load them from cache.
         
-        This functions simply loops over each filepath in each list and opens
-        all three(NDVI,VCI and VCI3M). The date is also extracted from the 
-        filepath and then the crop_to_shapefile function is called. Once all 
-        the files ahve been open,read,cropped and aggregated the save_to_hdf
-        function is called.
+        Returns
+        -------
+        None.
         
-        This functio ndoes not return anything but does update the raw_NDVI,raw
-        _VCI,raw_VCI3M,date and date_counter attributes
+        """
+        with rasterio.open(self.NDVI_files[0]) as dataset:
+            self.zones = zonal_statistics.zone_engine.cached(
+                self.zone_cache_file,self.shapefile_path,dataset,
+                self.zone_geometries)
+        
+    
+    def open_files(self,other_layers=()):
+        """Use rasterio to read each of the NDVI tifs and aggregate them.
+        
+        The shapes are first rasterized onto the NDVI grid, or loaded from the
+        cache if they have been before. The shapes of any other layers are
+        aggregated in the same pass, each date is then read once for all of
+        them. This functions then loops over each
+        filepath, a dekad at a time, reads the NDVI and calls the
+        crop_to_shapefile function. The date is also extracted from the
+        filepath. With more than one worker the dates are aggregated by
+        aggregate_in_parallel instead. Once all the files have been read and
+        aggregated the save_to_hdf function is called for every layer.
+        
+        This function does not return anything but does update the raw_NDVI,
+        min_max, date and date_counter attributes
+        
+        Parameters
+        ----------
+        other_layers : :obj:`List` of :obj:`aggregate_time_series`
+            Time series of other shapefiles over the same NDVI files to fill
+            in the same pass.
         
         Returns
         -------
         None.
         """
         
-        max_files = sorted(glob('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Min_Max_Pixels\\Max_*.tif'))
+        # The min and max of every dekad are read from the one climatology
+        # store, which is made from the Min_/Max_ tifs if it isn't there yet.
         
-        min_files = sorted(glob('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Min_Max_Pixels\\Min_*.tif'))
+        self.possible_dekadals = np.array(NDVI_Normalisation.DEKADS)
         
-        self.possible_dekadals = np.array(['0101', '0111', '0121', '0201', '0211', '0221', 
-                             '0301', '0311', '0321', '0401', '0411', '0421',
-                             '0501', '0511', '0521', '0601', '0611', '0621', 
-                             '0701', '0711', '0721', '0801', '0811', '0821', 
-                             '0901', '0911', '0921', '1001', '1011', '1021', 
-                             '1101', '1111', '1121', '1201', '1211', '1221'])
+        store_file = NDVI_Normalisation.climatology_store()
         
-        self.maxes = np.empty(36,dtype=object)
-        self.mins = np.empty(36,dtype=object)
+        self.climatology = rasterio.open(store_file)
         
+        self.layers = [self]+list(other_layers)
         
-        for counter,(max_file,min_file) in enumerate(zip(max_files,min_files)):
-            self.maxes[counter] = rasterio.open(max_file)
-            self.mins[counter]  = rasterio.open(min_file)
-            
+        for layer in self.layers:
+            layer.load_zones()
+        
+        if len(self.layers) == 1:
+            self.pass_zones = self.zones
+        else:
+            self.pass_zones = zonal_statistics.zone_engine.combine(
+                [layer.zones for layer in self.layers])
+        
+        # The dates are visited a dekad at a time, so each dekad's min and
+        # max is read once even when the cache can't hold all 36 of them.
+        # Each date is still stored in its own place in final_array.
+        
+        dekad_order = sorted(range(0,len(self.NDVI_files)),
+                             key=lambda counter: NDVI_Normalisation.file_dekad(
+                                 self.NDVI_files[counter]))
         
+        if self.workers > 1:
+            self.climatology.close()
+            self.aggregate_in_parallel(dekad_order,store_file)
         
-        for self.date_counter,NDVI_file in enumerate(self.NDVI_files):
+        else:
+            self.min_max = zonal_statistics.min_max_cache(
+                self.climatology,self.pass_zones,self.min_max_cache_bytes)
+        
+            for self.date_counter in dekad_order:
             
-            self.date = NDVI_file.split('\\')[-1].split('.tif')[0]
+                NDVI_file = self.NDVI_files[self.date_counter]
             
-            self.raw_NDVI   =  rasterio.open(NDVI_file)
+                self.date = NDVI_file.split('\\')[-1].split('.tif')[0]
             
-            self.crop_to_shapefile()
+                if self.cube is not None:
+                    self.raw_NDVI = self.cube.read_date(int(self.date[8:]))
+                else:
+                    with rasterio.open(NDVI_file) as dataset:
+                        self.raw_NDVI = dataset.read(1)
             
-            if self.date_counter%20 ==0:
-                np.save(('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Output_check\\'+self.date+' is done.npy'),np.arange(0,10))
-            print(self.date,' is complete')
+                self.crop_to_shapefile()
+            
+                if self.date_counter%20 ==0:
+                    np.save(('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Output_check\\'+self.date+' is done.npy'),np.arange(0,10))
+                print(self.date,' is complete')
+        
+            self.climatology.close()
         
-        self.create_VCI3M()
+        for layer in self.layers:
             
-        self.save_to_hdf()   
+            layer.create_VCI3M()
+            
+            layer.save_to_hdf()   
 
 
-    def crop_to_shapefile(self):
-        """ Use rasterio to crop the tif image to specified shape.
+    def aggregate_in_parallel(self,dekad_order,store_file):
+        """Aggregate the dates in a pool of worker processes.
         
-        The tif image is croped to shape using rasterio and then the null data
-        is masked so that when averaged it is not included.
+        The dates of each dekad are sent to a worker as one chunk and the
+        worker sends back the sums of NDVI and VCI over every shape of every
+        layer for each of them. These are put in final_array by their date_counter, so the
+        result is the same whatever order the chunks finish in. The chunks
+        are handed back through raster_io.bounded_map.
         
-        This module does not return anything but does update various
-        attributes, see source code.
+        Parameters
+        ----------
+        dekad_order : :obj:`List` of :obj:`int`
+            The date_counter of each date, grouped by dekad.
+        store_file : str
+            Filepath to the climatology store.
             
         Returns
         -------
         None.
         
         """
-        for shape_counter in range(0,len(self.datasets)):
-            
-            crop_boundaries=self.get_features(self.shapefile_data[self.
-                                        shapefile_data.index==shape_counter])
-            
-            NDVI,  to_ignore = mask(self.raw_NDVI,  crop_boundaries, crop=True)
-            
-            # self.final_NDVI = np.ma.array(np.where(NDVI <= 0.01, np.nan, NDVI)
-            #                         ,dtype='float32')
-            # If still not working also check for values greater than 1.
-            
-            
-            loc = int(np.where(self.possible_dekadals==str(self.date[12:]))[0])
-            
-            Max, to_ignore = mask(self.maxes[loc],
-                                             crop_boundaries, crop = True)
-                                             
-            Min, to_ignore = mask(self.mins[loc],
-                                             crop_boundaries, crop = True)                        
-            
-            self.NDVI   = np.ma.masked_array(NDVI)
+        chunks = []
+        for date_counter in dekad_order:
+            dekad = NDVI_Normalisation.file_dekad(
+                self.NDVI_files[date_counter])
+            if len(chunks) == 0 or chunks[-1][0] != dekad:
+                chunks.append((dekad,[]))
+            chunks[-1][1].append(date_counter)
+        
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=start_worker,
+                                 initargs=(self.pass_zones,
+                                           store_file,self.cube,
+                                           self.min_max_cache_bytes,
+                                           self.gdal_cache_mb)) as executor:
+            
+            for rows in raster_io.bounded_map(
+                    executor,aggregate_dates,
+                    (([self.NDVI_files[counter] for counter in date_counters],
+                      date_counters) for dekad,date_counters in chunks),
+                    self.workers):
+                self.store_rows(*rows)
+                
+    
+    def store_rows(self,date_counters,dates,rows):
+        """Put the rows of a chunk of dates from a worker in final_array."""
         
-            masked_mins = np.ma.masked_array(Min)
-            
-            masked_Max = np.ma.masked_array(Max)
+        for self.date_counter,self.date,row in zip(date_counters,dates,rows):
             
+            self.zone_sums = dict(zip(zonal_statistics.SUM_NAMES,row))
             
+            self.check_cloud_store()
             
-            self.raw_VCI    = 100*(self.NDVI-masked_mins)/(masked_Max-masked_mins)
-            
-            self.final_NDVI   = np.ma.masked_values(NDVI,1.175494351e-38)
-            self.final_VCI    = np.ma.masked_values(self.raw_VCI,1.175494351e-38)
+            if self.date_counter%20 ==0:
+                np.save(('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Output_check\\'+self.date+' is done.npy'),np.arange(0,10))
+            print(self.date,' is complete')
+    
+    
+    def crop_to_shapefile(self):
+        """ Aggregate the NDVI and VCI of the date over every shape.
+        
+        The min and max of the dekad come from the min/max cache. The pixels
+        of every shape are taken from the image at once and summed
+        per shape with np.bincount. The fill value is left out so that it is
+        not included in the averages, the same as cropping each shape with
+        rasterio and masking the fill value.
+        
+        This module does not return anything but does update various
+        attributes, see source code.
             
-            self.shape_counter = shape_counter
-
-            self.check_cloud_store()
+        Returns
+        -------
+        None.
+        
+        """
+        
+        Min,Max = self.min_max[self.date[12:]]
+        
+        self.zone_sums = self.pass_zones.zone_sums(self.raw_NDVI,Min,Max)
+        
+        self.check_cloud_store()
         
 
 
@@ -271,7 +716,7 @@ class aggregate_time_series:
         fill value. This function checks that when each shapefile has been 
         aggregated that it still contains more than 1% of the original data.
         If it does not, then instead of the average being inserted into the 
-        time series, a NaN value is.
+        time series, a NaN value is. This is done for every shape at once.
         
         This function does not return anyting but does update various 
         attributes, see source code.
@@ -282,59 +727,58 @@ class aggregate_time_series:
         
         """
 
+        self.final_NDVI,self.final_VCI = self.pass_zones.zone_means(
+            self.zone_sums)
+        
+        self.store_means(self.final_NDVI,self.final_VCI)
         
-        if self.final_NDVI.count()  <  self.NDVI.count()/100:
+    
+    def store_means(self,NDVI,VCI):
+        """Put the means and sums of every shape of the pass in each layer.
+        
+        The shapes of each layer follow on from those of the layer before,
+        as in pass_zones. The date goes in the row of date_counter.
+        """
+        
+        start = 0
+        
+        for layer in self.layers:
             
-            self.final_NDVI  = np.nan
+            end = start+len(layer.zones)
             
-        if self.final_VCI.count()   <   self.raw_VCI.count()/100:
+            layer.final_array[:,self.date_counter,0] = int(self.date[8:])
             
-            self.final_VCI   = np.nan
-
-
-
-        self.final_array[self.shape_counter,self.date_counter,0] = \
-            int(self.date[8:])
-        
-        self.final_array[self.shape_counter,self.date_counter,1] = \
-            np.nanmean(self.final_NDVI)
+            layer.final_array[:,self.date_counter,1] = NDVI[start:end]
+            
+            layer.final_array[:,self.date_counter,2] = VCI[start:end]
+            
+            for name in zonal_statistics.SUM_NAMES:
+                layer.final_sums[name][:,self.date_counter] = \
+                    self.zone_sums[name][start:end]
             
-        self.final_array[self.shape_counter,self.date_counter,2] = \
-            np.nanmean(self.final_VCI)
+            start = end
             
       
         
       
     def create_VCI3M(self):
+        """Find the VCI3M of every shape and date of a new time series.
+        
+        All shapes and dates are done at once by rolling_VCI3M. When data
+        is appended the VCI3M is found in save_to_hdf instead, once the
+        VCI of the dates before the new ones has been read from the
+        database, so it is left as 0 here.
+        
+        Returns
+        -------
+        None.
+        
+        """
         
         if self.new:
-                
-            for shape_counter in range(0,len(self.final_array)):
-                average_list = []
-                
-                for date_counter in range(0,9):
-    
-                    average_list.append(self.final_array[shape_counter,
-                                                         date_counter,2])
-                                
-                    self.final_array[shape_counter,date_counter,3] = \
-                        np.nanmean(np.array(average_list))
-                
-                
-                for date_counter in range(9,len(self.final_array[0])):
-                
-                    average_list.pop(0)
-                
-                    average_list.insert(-1,self.final_array[shape_counter,
-                                            date_counter,2])
-                
-                    self.final_array[shape_counter,date_counter,3] = \
-                        np.nanmean(np.array(average_list))
-                
-                print(self.final_array[0,:,3])
+            self.final_array[:,:,3] = rolling_VCI3M(self.final_array[:,:,2])
         else:
-                self.final_array[:,:,3] = \
-                    np.full(np.shape(self.final_array[:,:,3]),0)
+            self.final_array[:,:,3] = 0
 
             
     def save_to_hdf(self):
@@ -347,7 +791,7 @@ class aggregate_time_series:
         HDF file for each shape in the shapefile.
         
         If new is false, the data is just appended into a previously created 
-        timeseries database.
+        timeseries database and the VCI3M of the new dates is found.
         
         Returns
         -------
@@ -388,51 +832,93 @@ class aggregate_time_series:
             storage_file = h5.File(('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Databases\\'+str(file_name)+'.h5'), 'a')
 
             
+            # The last 10 rows of each dataset are the forecast, the new rows
+            # are written over them and the forecast is made again after.
+            # Only the VCI3M of the new rows is found, from their VCI and
+            # the VCI of the rows just before them.
+            
             for dataset_counter,dataset in enumerate(self.datasets):
                 
                 
                 data = storage_file[dataset]
                 
                 dataset_length = len(data)
+                
+                start = dataset_length-10
             
                 data.resize(dataset_length+len(self.final_array[0,:,0]),
                                axis=0)
                 
-                data[dataset_length-10:-10,:4] =self.final_array[dataset_counter,
-                                                             :,:]
-                
-                            
-            for dataset_counter,dataset in enumerate(self.datasets):
+                new_rows = self.final_array[dataset_counter,:,:].copy()
                 
-                VCI = storage_file[dataset][:-10,2].copy()
+                new_rows[:,3] = rolling_VCI3M(
+                    new_rows[:,2],data[max(start-VCI3M_WINDOW+1,0):start,2])
                 
-                VCI3M = np.empty(np.shape(VCI))
-            
-                average_list = []
+                data[start:-10,:4] = new_rows
                 
+            storage_file.close()
                 
-                for date_counter in range(0,9):
+            print('The new data has been added to the database successfully')
+        
+        self.save_sums()
     
-                    average_list.append(VCI[date_counter])
-                                
-                    VCI3M[date_counter] = \
-                        np.nanmean(np.array(average_list))
-                
-                
-                for date_counter in range(9,len(VCI)):
-                
-                    average_list.pop(0)
-                
-                    average_list.insert(-1,VCI[date_counter])
-                
-                    VCI3M[date_counter] = \
-                        np.nanmean(np.array(average_list))
+    
+    def save_sums(self):
+        """Save the sums and pixel counts of each shape next to the database.
+        
+        They are kept in <database>_sums.h5 as one (shapes, dates) dataset
+        per sum, with the dates, the names of the shapes and the window of
+        each shape. New dates are added on to the end. If a database was
+        made before the sums were kept, the file starts from the new dates.
+        
+        Returns
+        -------
+        None.
+        
+        """
+        
+        file_name = self.shapefile_path.split('.shp')[0].split('\\')[-1]
+        
+        sums_file = ('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Databases\\'+str(file_name)+'_sums.h5')
+        
+        dates = self.final_array[0,:,0].astype('int64') if \
+            len(self.final_array) else np.array([],dtype='int64')
+        
+        if self.new or not os.path.exists(sums_file):
             
-                             
-                storage_file[dataset][:-10,3] = VCI3M
+            with h5.File(sums_file,'w') as storage_file:
                 
-            storage_file.close()
+                storage_file.create_dataset('Dates',data=dates,
+                                            maxshape=(None,))
+                storage_file.create_dataset('Zones',data=np.array(
+                    [name.encode() for name in self.datasets],dtype='S'))
+                storage_file.create_dataset('Windows',data=self.zones.windows)
                 
-            print('The new data has been added to the database successfully')
+                for name in zonal_statistics.SUM_NAMES:
+                    storage_file.create_dataset(name,data=self.final_sums[name],
+                                                compression='lzf',
+                                                chunks=True,
+                                                maxshape=(len(self.datasets),
+                                                          None))
+            return
+        
+        with h5.File(sums_file,'a') as storage_file:
+            
+            stored_dates = storage_file['Dates']
+            
+            new_dates = np.ones(len(dates),dtype='bool')
+            if len(stored_dates):
+                new_dates = dates > stored_dates[-1]
+            
+            start = len(stored_dates)
+            end = start+int(new_dates.sum())
+            
+            stored_dates.resize((end,))
+            stored_dates[start:end] = dates[new_dates]
+            
+            for name in zonal_statistics.SUM_NAMES:
+                storage_file[name].resize(end,axis=1)
+                storage_file[name][:,start:end] = \
+                    self.final_sums[name][:,new_dates]
 
    
\ No newline at end of file
@@ -12,13 +12,39 @@ import sys
 import os
 import shutil
 import fix_size
+import raster_io
 import whittaker_smoothing
+import NDVI_cube
 import NDVI_Normalisation
 import Aggregate
+import VCI_rasters
 import Forecast
 import Hindcasts
 
 
+def add_to_smoothed_cube(smoothed_cube,smoothed_files):
+    
+    # Adds any smoothed dates that are not in the cube yet. Does nothing when
+    # the cubes are not being used.
+    
+    if smoothed_cube is not None:
+        smoothed_cube.append(smoothed_files,
+                             [file.split('Smoothed')[1].split('.tif')[0]
+                              for file in smoothed_files])
+
+
+def baseline_years(climatology_baseline,smoothed_files):
+    
+    # The years the min/max are found over. If none are given the first 18
+    # years of the smoothed NDVI are used.
+    
+    if climatology_baseline is not None:
+        return climatology_baseline
+    
+    first_year = NDVI_Normalisation.file_year(smoothed_files[0])
+    return (first_year,first_year+17)
+
+
 def main():
 
 
@@ -50,6 +76,19 @@ def main():
     convert_NDVI_from_scratch_list = [True,False]
     
     
+    # The time series of every shapefile are made together after the loop,
+    # in one pass over the smoothed NDVI, and are then forecast.
+    
+    time_series = []
+    
+    forecasts = []
+    
+    # Index of the first smoothed file each shapefile needs the VCI rasters
+    # of. The rasters don't depend on the shapefile, so they are written once
+    # after the loop, from the earliest of these.
+    
+    VCI_from = []
+    
     for shape,column,new_time_series,from_scratch in zip(shape_files,shape_file_columns,create_new_time_series_list,convert_NDVI_from_scratch_list):
     
         create_new_time_series = new_time_series
@@ -76,6 +115,71 @@ def main():
         # This is a path to where the smoothed data will be stored.
         smoothed_NDVI_filepath = 'C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\smoothed_NDVI'
         
+        # Number of processes that smooth strips in parallel and the memory in
+        # bytes the smoothing may use in total. The strips are sized to fit the
+        # memory, with it left as None half of the machine's memory is used.
+        
+        smoothing_workers = 1
+        smoothing_memory_budget = None
+        
+        # When appending, compare the new smoothing with the values smoothed
+        # in the last run and write a Change_depth tif showing how far back
+        # the new data moved them. This needs the smoothed tifs of the dekads
+        # before the new data to still be there.
+        
+        incremental_smoothing = True
+        
+        # Optionally keep all of the raw and smoothed NDVI in two data cubes. The
+        # smoothing and aggregation then read from the cubes rather than from
+        # hundreds of separate tifs. New dekads are added to the cubes each run.
+        
+        use_NDVI_cubes = False
+        
+        raw_cube_filepath = 'C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Cubes\\Raw_NDVI.h5'
+        
+        smoothed_cube_filepath = 'C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Cubes\\Smoothed_NDVI.h5'
+        
+        # Files from 2017 onwards are slightly smaller than the rest. With this
+        # set they are left as they are and read as if padded out to the full
+        # grid, using a record of where each file sits on it. Otherwise the
+        # files are rewritten at the full size by fix_size.
+        
+        align_NDVI_virtually = True
+        
+        # First and last year of the smoothed NDVI used for the min/max of each
+        # pixel. Left as None the first 18 years are used. The number of
+        # processes the min/max finding is split between is also set here.
+        
+        climatology_baseline = None
+        climatology_workers = 1
+        
+        # Also find the mean, standard deviation and 5th/95th percentile of
+        # each pixel for each dekad, in the same pass as the min/max. When
+        # appending, these are found again from every year of each dekad with
+        # new data, so they are off by default.
+        
+        extra_climatology_statistics = False
+        
+        # How the min/max are updated with new dekads when appending. 'frozen'
+        # only adds dekads inside the baseline years, 'extend' adds every new
+        # year and 'rolling' keeps only the latest years, as many as are in
+        # the baseline.
+        
+        climatology_update_mode = 'frozen'
+        
+        # Number of processes the dates are aggregated over the shapes in.
+        
+        aggregation_workers = 1
+        
+        # Also write a VCI and VCI3M tif of every date, maps of the whole
+        # country. These take a lot of disk space so are off by default.
+        
+        create_VCI_rasters = False
+        
+        VCI_filepath = 'C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\VCI'
+        
+        grid_alignment_filepath = 'C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Grid_alignment.json'
+        
         # Path to the database. This is currently hardcoded in some places but I 
         # hope to update this in the future to make it more robust.
         
@@ -105,8 +209,32 @@ def main():
         smoothed_NDVI = sorted(glob(smoothed_NDVI_filepath+'\\*.tif'))
     
     
-        fix_size.change_file_size(unsmoothed_NDVI,NDVI_filepath)
+        grid = None
         
+        if align_NDVI_virtually:
+            
+            grid = raster_io.grid_alignment(grid_alignment_filepath)
+            
+            if grid.register(unsmoothed_NDVI) != 0:
+                grid.save()
+                
+        else:
+            
+            fix_size.change_file_size(unsmoothed_NDVI,NDVI_filepath)
+        
+        raw_cube = None
+        smoothed_cube = None
+        
+        if use_NDVI_cubes:
+            
+            raw_cube = NDVI_cube.NDVI_cube(raw_cube_filepath)
+            
+            raw_cube.append(unsmoothed_NDVI,
+                            [file.split('dekadal.')[1].split('.tif')[0]
+                             for file in unsmoothed_NDVI],grid=grid)
+            
+            smoothed_cube = NDVI_cube.NDVI_cube(smoothed_cube_filepath)
+            
         
         if create_new_time_series and convert_NDVI_from_scratch:
             
@@ -119,43 +247,46 @@ def main():
             
             #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
             # Smooth each pixel
-            whittaker_smoothing.run_smoothing(unsmoothed_NDVI,False,0)
+            whittaker_smoothing.run_smoothing(unsmoothed_NDVI,False,0,
+                                              smoothing_workers,
+                                              smoothing_memory_budget,
+                                              smoothed_NDVI_filepath,
+                                              raw_cube,grid=grid)
+            
+            smoothed_NDVI = sorted(glob(smoothed_NDVI_filepath+'\\*.tif'))
        
         
             #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
             # Activate min/max normalisation class
-            Nomalise_NDVI = NDVI_Normalisation.NDVI_normalisation(smoothed_NDVI)
+            Nomalise_NDVI = NDVI_Normalisation.NDVI_normalisation(
+                smoothed_NDVI,baseline_years(climatology_baseline,
+                                             smoothed_NDVI),
+                climatology_workers,
+                extra_statistics=extra_climatology_statistics)
     
             # Run the min/max finding algorithm
             Nomalise_NDVI.normalise()
         
             #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+            add_to_smoothed_cube(smoothed_cube,smoothed_NDVI)
+            
+            VCI_from.append(0)
+            
             #Activate class to create time series
             create_time_series = \
                 Aggregate.aggregate_time_series(smoothed_NDVI,
                                                 shapefile_filepath,
                                                 create_new_time_series,
                                                 
-                                                name_of_shapefile_column)
-            # Run time series creation algorithm
-            create_time_series.open_files()
-    
+                                                name_of_shapefile_column,
+                                                smoothed_cube,
+                                                workers=aggregation_workers)
+            # The time series is created after the loop, then hindcast and
+            # forecast
+            time_series.append(create_time_series)
             
-            # Use the databse (HDF5 file) to create hindcasts
-            database_name= shapefile_filepath.split('.shp')[0].split('\\')[-1]
-    
-            #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
-            # Activate class
-            create_hindcasts = Hindcasts.hindcast(database_name)
-            #Create Hindcasts
-            create_hindcasts.open_dataset()
-    
-            #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
-            # Create forecasts
-            create_the_forecasts = Forecast.forecast(database_name,
-                                                      shapefile_filepath,
-                                                      name_of_shapefile_column)
-            create_the_forecasts.open_dataset()
+            forecasts.append((shapefile_filepath,name_of_shapefile_column,
+                              True))
     
             
         elif create_new_time_series is True and convert_NDVI_from_scratch is False:
@@ -164,35 +295,23 @@ def main():
             # from the smoothed NDVI and then forecasts this new database.
             
             #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+            add_to_smoothed_cube(smoothed_cube,smoothed_NDVI)
+            
             #Activate class to create time series
             create_time_series = \
                 Aggregate.aggregate_time_series(smoothed_NDVI,
                                                 shapefile_filepath,
                                                 create_new_time_series,
-                                                name_of_shapefile_column)
+                                                name_of_shapefile_column,
+                                                smoothed_cube,
+                                                workers=aggregation_workers)
                 
-            # Run time series creation algorithm
-            create_time_series.open_files()
-    
+            # The time series is created after the loop, then hindcast and
+            # forecast
+            time_series.append(create_time_series)
             
-            # Grab name of shapefile as this is will be the name of the database.
-            database_name= shapefile_filepath.split('.shp')[0].split('\\')[-1]
-    
-            
-            #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
-            # Activate class
-            create_hindcasts = Hindcasts.hindcast(database_name)
-            #Create Hindcasts
-            create_hindcasts.open_dataset()
-    
-            
-            #Create forecasts
-            #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
-            create_the_forecasts = Forecast.forecast(database_name,
-                                                      shapefile_filepath,
-                                                      name_of_shapefile_column)
-            
-            create_the_forecasts.open_dataset()
+            forecasts.append((shapefile_filepath,name_of_shapefile_column,
+                              True))
         else:    
             # This is the last option. It appends on new data to a database (again,
             # dictated by what the shapefile is called.)
@@ -216,8 +335,6 @@ def main():
             
             new_NDVI_files = np.array(unsmoothed_NDVI)[new_data_mask].tolist()
             
-            database_name= shapefile_filepath.split('.shp')[0].split('\\')[-1]
-            
             smoothed_NDVI = sorted(glob(smoothed_NDVI_filepath+'\\*.tif'))
             
             #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
@@ -237,12 +354,27 @@ def main():
                     for_smoothing = (unsmoothed_NDVI[-36-len(new_NDVI_files):
                                                      -len(new_NDVI_files)] +
                                      new_NDVI_files)
+                    
+                    previous_smoothed = [smoothed_NDVI_filepath+'\\Smoothed'+
+                                         file.split('dekadal.')[1]
+                                         for file in for_smoothing[:36]]
+                    
+                    if not (incremental_smoothing and
+                            all(os.path.exists(file) for file in
+                                previous_smoothed)):
+                        previous_smoothed = None
                                      
                     
                     
                     
                     whittaker_smoothing.run_smoothing(for_smoothing,True,
-                                                      len(new_NDVI_files))
+                                                      len(new_NDVI_files),
+                                                      smoothing_workers,
+                                                      smoothing_memory_budget,
+                                                      smoothed_NDVI_filepath,
+                                                      raw_cube,
+                                                      previous_smoothed,
+                                                      grid=grid)
         
         
                 # This follows the same process as above. It simply gets the newly
@@ -258,38 +390,73 @@ def main():
                 
                 new_smoothed_NDVI = np.array(smoothed_NDVI)[new_data_mask].tolist()
                 
+                # Update the min/max of just the dekads of the new data
+                Nomalise_NDVI = NDVI_Normalisation.NDVI_normalisation(
+                    smoothed_NDVI,baseline_years(climatology_baseline,
+                                                 smoothed_NDVI),
+                    climatology_workers,
+                    extra_statistics=extra_climatology_statistics)
+                
+                Nomalise_NDVI.update(new_smoothed_NDVI,climatology_update_mode)
+                
+                add_to_smoothed_cube(smoothed_cube,new_smoothed_NDVI)
+                
+                VCI_from.append(len(smoothed_NDVI)-len(new_smoothed_NDVI))
                 
                 create_time_series = \
                     Aggregate.aggregate_time_series(new_smoothed_NDVI,
                                                     shapefile_filepath,
                                                     create_new_time_series,
-                                                    name_of_shapefile_column)
+                                                    name_of_shapefile_column,
+                                                    smoothed_cube,
+                                                    workers=aggregation_workers)
                     
-                    
-                  
-                create_time_series.open_files()
-         
+                time_series.append(create_time_series)
             
-                create_the_forecasts = Forecast.forecast(database_name,
-                                                          shapefile_filepath,
-                                                          name_of_shapefile_column)
-                
-                create_the_forecasts.open_dataset()
-                
-            else:
-                
-                create_the_forecasts = Forecast.forecast(database_name,
-                                                          shapefile_filepath,
-                                                          name_of_shapefile_column)
-                
-                create_the_forecasts.open_dataset()
-       
-       # Throughout the process some files are stored in output check so that you 
-       # can see where the program has progressed to without using a console etc.
-       
-        shutil.rmtree('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Output_check')
+            # Forecast from the database, with the new data if there is any
+            forecasts.append((shapefile_filepath,name_of_shapefile_column,
+                              False))
+    
     
-        os.mkdir('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Output_check')
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+    if create_VCI_rasters and VCI_from:
+        VCI_rasters.run_VCI(smoothed_NDVI,min(VCI_from),
+                            output_filepath=VCI_filepath,cube=smoothed_cube)
+    
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+    # Time series of the same smoothed files are aggregated in one pass, each
+    # date is read once for all of their shapefiles. Each shapefile still has
+    # its own database.
+    
+    Aggregate.aggregate_layers(time_series)
+    
+    for shapefile_filepath,name_of_shapefile_column,hindcasts in forecasts:
+        
+        # Grab name of shapefile as this is will be the name of the database.
+        database_name= shapefile_filepath.split('.shp')[0].split('\\')[-1]
+        
+        if hindcasts:
+            
+            #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+            # Activate class
+            create_hindcasts = Hindcasts.hindcast(database_name)
+            #Create Hindcasts
+            create_hindcasts.open_dataset()
+        
+        #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
+        # Create forecasts
+        create_the_forecasts = Forecast.forecast(database_name,
+                                                  shapefile_filepath,
+                                                  name_of_shapefile_column)
+        
+        create_the_forecasts.open_dataset()
+   
+    # Throughout the process some files are stored in output check so that you 
+    # can see where the program has progressed to without using a console etc.
+   
+    shutil.rmtree('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Output_check')
+
+    os.mkdir('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Output_check')
     
     
     
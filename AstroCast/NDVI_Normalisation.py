@@ -1,21 +1,311 @@
 # -*- coding: utf-8 -*-
 """ Class containing functions that find the min and max for each pixel.
 
-This class takes the input of a list of file paths for NDVI tif images. 
+This class takes the input of a list of file paths for NDVI tif images.
 It will then take these images, and for each time step (each of the 36 dekadals)
 the minimum and the maximum will be found for each pixel accross all years.
 This data will then be dumped to a file so that it can be read later.
 
+As well as a Min_/Max_ tif for each timestep, all 72 layers are kept in one
+band interleaved, tiled tif, the climatology store, so the min and max of any
+window for any dekads can be read through one open file.
+
 Created on Thu Mar 12 10:08:43 2020 @author: Andrew Bowell
 """
 
 # Importing the needed modules
 
+import os
+import json
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
 import rasterio
 import numpy as np
+from rasterio.windows import Window
+
+import raster_io
+
+
+# The 36 dekads in the order of the bands of the climatology store. Band n
+# holds the min of DEKADS[n-1] and band n+36 its max.
+DEKADS = ['0101', '0111', '0121', '0201', '0211', '0221',
+          '0301', '0311', '0321', '0401', '0411', '0421',
+          '0501', '0511', '0521', '0601', '0611', '0621',
+          '0701', '0711', '0721', '0801', '0811', '0821',
+          '0901', '0911', '0921', '1001', '1011', '1021',
+          '1101', '1111', '1121', '1201', '1211', '1221']
+
+
+def file_dekad(file):
+    """Dekad of a file in the format %m%d, e.g. 0101."""
+    return file.split('\\')[-1].split('.tif')[0][-4:]
+
+
+def file_year(file):
+    """Year of a file as an int."""
+    return int(file.split('\\')[-1].split('.tif')[0][-8:-4])
+
+
+def store_bands(timesteps):
+    """Bands of the climatology store with the min and max of the timesteps.
+
+    Parameters
+    ----------
+    timesteps : :obj:`list` of :obj:`str`
+        Dekads in the format %m%d, e.g. 0101.
+
+    Returns
+    -------
+    :obj:`list` of :obj:`int`
+        Band of the min of each timestep.
+    :obj:`list` of :obj:`int`
+        Band of the max of each timestep.
+
+    """
+    mins = [DEKADS.index(timestep)+1 for timestep in timesteps]
+    return mins,[band+36 for band in mins]
+
+
+def open_climatology_store(store_file,meta_data=None):
+    """Open the climatology store to write to, creating it if meta is given.
+
+    The bands are interleaved by band, so reading a few dekads only
+    decompresses the tiles of those bands.
+    """
+    if meta_data is None:
+        return rasterio.open(store_file,'r+')
+
+    profile = meta_data.copy()
+    profile.update(driver='GTiff',count=72,tiled=True,blockxsize=128,
+                   blockysize=128,compress='deflate',interleave='band')
+
+    dataset = rasterio.open(store_file,'w',**profile)
+    for band,timestep in enumerate(DEKADS,start=1):
+        dataset.set_band_description(band,'Min_'+timestep)
+        dataset.set_band_description(band+36,'Max_'+timestep)
+    return dataset
+
+
+def write_changed_tiles(dataset,band,stored,updated):
+    """Write only the tiles of a band where updated differs from stored."""
+    for _,window in dataset.block_windows(band):
+        rows,columns = window.toslices()
+        if not np.array_equal(stored[rows,columns],updated[rows,columns],
+                              equal_nan=True):
+            dataset.write(updated[rows,columns],band,window=window)
+
+
+def climatology_store(min_max_filepath='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Min_Max_Pixels'):
+    """Path to the climatology store, made from the Min_/Max_ tifs if needed.
+
+    Parameters
+    ----------
+    min_max_filepath : str
+        Folder holding the Min_/Max_ tifs.
+
+    Returns
+    -------
+    str
+        Path to the 72 band climatology store.
+
+    """
+    store_file = os.path.join(min_max_filepath,'Climatology.tif')
+
+    if os.path.exists(store_file):
+        return store_file
+
+    min_files = sorted(glob(os.path.join(min_max_filepath,'Min_*.tif')))
+
+    with rasterio.open(min_files[0]) as dataset:
+        meta_data = dataset.meta.copy()
+
+    # The store is written under a temporary name and only moved into place
+    # once every band is in it, so a failed build never leaves a store behind
+    # that would be taken as finished.
+    with open_climatology_store(store_file+'.tmp',meta_data) as store:
+        for min_file in min_files:
+            timestep = file_dekad(min_file)
+            min_band,max_band = [bands[0] for bands in store_bands([timestep])]
+            with rasterio.open(min_file) as dataset:
+                store.write(dataset.read(1),min_band)
+            with rasterio.open(os.path.join(min_max_filepath,
+                                            'Max_'+timestep+'.tif')) as dataset:
+                store.write(dataset.read(1),max_band)
+
+    os.replace(store_file+'.tmp',store_file)
+
+    print('Climatology store made from ',len(min_files),' Min/Max tifs')
+    return store_file
+
+
+# Each worker process keeps its own pool so a file is opened once per worker
+# rather than once per strip.
+worker_pool = None
+
+
+def start_worker(max_open):
+    global worker_pool
+    worker_pool = raster_io.dataset_pool(max_open)
+
+
+# Layers of the climatology in the order strip_statistics returns them. The
+# min and max are always found, the rest only when extra statistics are asked
+# for. Std is the standard deviation over the years (ddof 0, as numpy's std)
+# and P05/P95 the 5th and 95th percentiles.
+STATISTICS = ['Min','Max','Mean','Std','P05','P95']
+
+
+def tail_length(number_of_files,percentile=5):
+    """Values kept in each tail to find a percentile of this many files."""
+    return min(int(percentile/100*(number_of_files-1))+2,number_of_files)
 
 
+def insert_into_tail(tail,values):
+    """Insert values into a stack of the smallest values seen, kept sorted.
 
+    The tail has shape (k, height, width) and starts as inf. The largest of
+    the k+1 values is dropped, so after every file the tail holds the k
+    smallest values so far in increasing order.
+    """
+    for row in tail:
+        lower = np.minimum(row,values)
+        values = np.maximum(row,values)
+        row[...] = lower
+
+
+def tail_percentile(smallest,largest,count,percentile):
+    """Percentile from the sorted tails, interpolated as numpy does.
+
+    Parameters
+    ----------
+    smallest : :obj:`3-D NumPy array` of :obj:`float`
+        The k smallest values of each pixel in increasing order.
+    largest : :obj:`3-D NumPy array` of :obj:`float`
+        The k largest values of each pixel in decreasing order.
+    count : :obj:`2-D NumPy array` of :obj:`int`
+        Number of values, NaNs aside, of each pixel.
+    percentile : float
+        Percentile to find. The tails must be at least
+        tail_length(files,min(percentile,100-percentile)) long.
+
+    Returns
+    -------
+    :obj:`2-D NumPy array` of :obj:`float`
+        The percentile of each pixel, NaN where there are no values.
+
+    """
+    position = percentile/100*np.maximum(count-1,0)
+    lower = np.floor(position).astype('int64')
+    upper = np.minimum(lower+1,np.maximum(count-1,0))
+    fraction = position-lower
+
+    # The k-th value from the top is the (count-1-k)-th from the bottom
+    if percentile <= 50:
+        tail = smallest
+    else:
+        tail = largest
+        lower,upper = count-1-lower,count-1-upper
+
+    last = len(tail)-1
+    lower = np.clip(lower,0,last)[None]
+    upper = np.clip(upper,0,last)[None]
+
+    below = np.take_along_axis(tail,lower,0)[0]
+    above = np.take_along_axis(tail,upper,0)[0]
+
+    # A pixel with no values still has its tail at inf, so only pixels with
+    # values are interpolated
+    found = count > 0
+    values = np.full(np.shape(count),np.nan)
+    values[found] = (below[found]*(1-fraction[found]) +
+                     above[found]*fraction[found])
+    return values
+
+
+def strip_statistics(dekad_files,pos_x,Window_x_size,Window_y_size,pool=None,
+                     extra_statistics=False):
+    """Find the climatology of every dekad over one strip of the image.
+
+    Each file is read once. Everything starts again from the first file of
+    each dekad, so nothing carries over from one dekad to the next. The mean
+    and variance are kept with Welford's method and the percentiles from the
+    few smallest and largest values of each pixel, so memory does not grow
+    with the number of years. NaNs are ignored throughout.
+
+    Parameters
+    ----------
+    dekad_files : :obj:`list` of :obj:`list` of :obj:`str`
+        The files of each dekad.
+    pos_x : int
+        Column offset of the strip.
+    Window_x_size,Window_y_size : int
+        Width and height of the strip.
+    pool : :obj:`raster_io.dataset_pool`
+        Pool to read through, the pool of the worker process if None.
+    extra_statistics : bool
+        Find the mean, std and percentiles as well as the min and max.
+
+    Returns
+    -------
+    int
+        Column offset of the strip.
+    :obj:`4-D NumPy array` of :obj:`float`
+        The layers of each dekad, shape (layers, dekads, height, width), the
+        layers in the order of STATISTICS.
+
+    """
+    pool = worker_pool if pool is None else pool
+
+    layers = len(STATISTICS) if extra_statistics else 2
+
+    climatology = np.empty((layers,len(dekad_files),Window_y_size,
+                            Window_x_size),dtype='float32')
+    mins,maxes = climatology[0],climatology[1]
+
+    for counter,files in enumerate(dekad_files):
+
+        if extra_statistics:
+            count = np.zeros((Window_y_size,Window_x_size),dtype='int32')
+            mean = np.zeros((Window_y_size,Window_x_size))
+            M2 = np.zeros((Window_y_size,Window_x_size))
+            k = tail_length(len(files))
+            smallest = np.full((k,Window_y_size,Window_x_size),np.inf,
+                               dtype='float32')
+            largest = np.full_like(smallest,np.inf)
+
+        for number,file in enumerate(files):
+
+            NDVI = pool.read_window(file,pos_x,0,Window_x_size,Window_y_size)
+
+            if number == 0:
+                mins[counter] = NDVI
+                maxes[counter] = NDVI
+            else:
+                np.fmin(mins[counter],NDVI,out=mins[counter])
+                np.fmax(maxes[counter],NDVI,out=maxes[counter])
+
+            if extra_statistics:
+                valid = ~np.isnan(NDVI)
+                count += valid
+                delta = np.where(valid,NDVI-mean,0)
+                mean += delta/np.maximum(count,1)
+                M2 += delta*np.where(valid,NDVI-mean,0)
+
+                # The largest values are kept as the smallest of -NDVI
+                insert_into_tail(smallest,np.where(valid,NDVI,np.inf))
+                insert_into_tail(largest,np.where(valid,-NDVI,np.inf))
+
+        if extra_statistics:
+            with np.errstate(invalid='ignore',divide='ignore'):
+                climatology[2,counter] = np.where(count > 0,mean,np.nan)
+                climatology[3,counter] = np.sqrt(M2/count)
+            climatology[4,counter] = tail_percentile(smallest,-largest,count,
+                                                     5)
+            climatology[5,counter] = tail_percentile(smallest,-largest,count,
+                                                     95)
+
+    return pos_x,climatology
 
 
 class NDVI_normalisation:
@@ -24,125 +314,369 @@ class NDVI_normalisation:
 
     Attributes
     ----------
-    
-    files : :obj:`NumPy array` of :obj:`object`
-        Array of file paths to NDVI tif data
+
+    files : :obj:`list` of :obj:`str`
+        File paths to the NDVI tif data inside the baseline period
+    baseline : :obj:`tuple` of :obj:`int`
+        First and last year (inclusive) used for the min/max, or None to use
+        every year given
     timesteps : :obj:`list` of :obj:`str`
         List of different timesteps (e.g each dekadal) format of %m%d e.g 0101
-    NDVI : :obj:`2-D NumPy array` of :obj:`float`
-        NDVI data read in from tif file
-    maxes : :obj:`2-D NumPy Array` of :obj:`float`
-        Max value for each pixel computed for each timestep using the numpy
-        fmax function. NaNs are ignored.
-    mins : :obj:`2-D Numpy array` of :obj:`float`
-        min value for each pixel computed for each timestep using the numpy
-        fmin function. NaNs are ignored.
-    timestep : str
-        Singular timestep in format of %m%d e.g 0101
-
-    """    
-    
-    def __init__(self,NDVI_file_list):
+    dekad_files : :obj:`dict` of :obj:`list` of :obj:`str`
+        The files of each timestep, in date order
+    workers : int
+        Number of processes the strips are split between
+    strip_width : int
+        Width in columns of the strips the image is processed in
+    output_filepath : str
+        Folder the Min_/Max_ tifs are written to
+    meta_data : dict
+        Rasterio meta data of the NDVI tifs
+    archive : :obj:`list` of :obj:`str`
+        Every file given, inside the baseline or not, used to rebuild a dekad
+        when the climatology rolls forward
+    contributors_file : str
+        Json file recording the years that went into the min/max of each
+        timestep
+    extra_statistics : bool
+        Whether the mean, std and 5th/95th percentiles are found as well
+
+    """
+
+    def __init__(self,NDVI_file_list,baseline=None,workers=1,strip_width=128,
+                 output_filepath='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Min_Max_Pixels',
+                 extra_statistics=False):
         """Initiate the attributes.
-        
-        Some small computations in here to make sure data is in the format 
-        needed
-        
-        Note
-        ----
-        Numpy arrays created as type object so strings can be stored
-        
+
+        The files are grouped by dekad here, once, so each file is only looked
+        at once however many dekads there are.
+
         Parameters
         ----------
         NDVI_file_list : :obj:`List` of :obj:`string`
             List of filepaths for the NDVI tif files.
-        
+        baseline : :obj:`tuple` of :obj:`int`
+            First and last year (inclusive) of the files to find the min/max
+            over. Every file given is used if None.
+        workers : int
+            Number of processes the strips are split between.
+        strip_width : int
+            Width in columns of the strips the image is processed in. A
+            multiple of 32 lines the strips up with the tiles of the smoothed
+            tifs. Each strip in flight holds 72 layers of this many columns,
+            216 with the extra statistics.
+        output_filepath : str
+            Folder the Min_/Max_ tifs are written to.
+        extra_statistics : bool
+            Also find the mean, std and 5th/95th percentile of each pixel for
+            each timestep, in the same pass over the files. They are written
+            to Mean_/Std_/P05_/P95_ tifs next to the Min_/Max_ ones.
+
         """
-        
-        self.files = np.array(NDVI_file_list,dtype=object)[:648]
-        self.timesteps = [path.split('\\')[-1].split('.tif')[0][12:]
-                          for path in self.files[:36]]
-        self.NDVI = None
-        self.maxes = None
-        self.mins = None
-        self.timestep = None#
-        self.meta_data = rasterio.open(self.files[0]).meta.copy()
-
-        
-    def save_file(self):
-        """Small function that saves the min/max arrays to a file.
-    
-        Not much to mention here, the files are saved with the name being the
-        timestep (E.g. The dekadal, 0101 or 1221 for example). This is so that 
-        the data can then be retreived  at a later date and used to create VCI
-        from the NDVI.
-        
-        This function does not return anything, but does update the mins and 
-        maxes attribute.
-        
-        Returns
-        -------
-        None.
-    
-        """        
-
-        with rasterio.open('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Min_Max_Pixels\\Min_'+ str(self.timestep)+\
-                           '.tif', "w",**self.meta_data) as dest:
-                                    
-           dest.write(self.mins,1)
-           
-        with rasterio.open('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Min_Max_Pixels\\Max_'+str(self.timestep)+\
-                          '.tif', "w",**self.meta_data) as dest:
-                                    
-           dest.write(self.maxes,1)
-           
-           
-        print(self.timestep, ' has been written to tif')
-                
+
+        self.baseline = baseline
+        self.files = [file for file in NDVI_file_list
+                      if baseline is None or
+                      baseline[0] <= file_year(file) <= baseline[1]]
+
+        self.dekad_files = {}
+        for file in self.files:
+            self.dekad_files.setdefault(file_dekad(file),[]).append(file)
+
+        self.timesteps = sorted(self.dekad_files)
+        self.workers = workers
+        self.strip_width = strip_width
+        self.output_filepath = output_filepath
+        self.extra_statistics = extra_statistics
+
+        self.archive = list(NDVI_file_list)
+        self.contributors_file = os.path.join(output_filepath,
+                                              'Contributors.json')
+
+        with rasterio.open(self.archive[0]) as dataset:
+            self.meta_data = dataset.meta.copy()
+
+
+    def output_files(self,prefix):
+        """Paths of the output tifs of every timestep for one layer, e.g. Min."""
+        return [os.path.join(self.output_filepath,prefix+'_'+timestep+'.tif')
+                for timestep in self.timesteps]
+
+
+    def strips(self):
+        """Yield the climatology of each strip of the image as it is done.
+
+        With more than one worker the strips are done in a process pool and
+        handed back in order by raster_io.bounded_map.
+        """
+
+        dekad_files = [self.dekad_files[timestep]
+                       for timestep in self.timesteps]
+
+        width = self.meta_data['width']
+        height = self.meta_data['height']
+
+        blocks = [(pos_x,min(self.strip_width,width-pos_x))
+                  for pos_x in range(0,width,self.strip_width)]
+
+        if self.workers <= 1:
+            with raster_io.dataset_pool() as pool:
+                for pos_x,strip_width in blocks:
+                    yield strip_statistics(dekad_files,pos_x,strip_width,
+                                           height,pool,self.extra_statistics)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=start_worker,
+                                 initargs=(256,)) as executor:
+
+            yield from raster_io.bounded_map(
+                executor,strip_statistics,
+                ((dekad_files,pos_x,strip_width,height,None,
+                  self.extra_statistics) for pos_x,strip_width in blocks),
+                self.workers)
+
 
     def normalise(self):
         """The function calculates the min and maxes for each pixel.
-            
-        The function iterates through each timestep (dekadal) and compares it 
-        with the name of the file. If the name of the file matches that of the
-        time step it is included in the min and max calcualtion. This is 
-        repeated for each timestep. The function relies on rasterio to open
-        the raw NDVI file and read it, then the NumPy fmax/fmin function is
-        used to find the min and maxes. 
-        
-        This function does not return anything but does call the save_file
-        function to save the file.
-        
+
+        The image is split into strips and for each strip every file is read
+        once, updating the running min and max of its dekad with the NumPy
+        fmin/fmax functions, so NaNs are ignored. With extra_statistics the
+        mean, std and percentiles are found in the same pass. Each finished
+        strip is written straight into its window of the tif of every layer
+        and dekad and of the climatology store, so only the strips in flight
+        are held in memory.
+
+        This function does not return anything.
+
         Returns
         -------
         None.
-    
+
+        """
+
+        os.makedirs(self.output_filepath,exist_ok=True)
+
+        min_bands,max_bands = store_bands(self.timesteps)
+
+        layers = STATISTICS if self.extra_statistics else STATISTICS[:2]
+
+        store_file = os.path.join(self.output_filepath,'Climatology.tif')
+
+        with raster_io.tif_writer(sum([self.output_files(layer)
+                                       for layer in layers],[]),
+                                  self.meta_data) as writer, \
+             open_climatology_store(store_file+'.tmp',
+                                    self.meta_data) as store:
+
+            for pos_x,climatology in self.strips():
+
+                height,width = climatology.shape[2:]
+
+                writer.write_block(climatology.reshape(-1,height,width),
+                                   pos_x,0)
+
+                store.write(climatology[:2].reshape(-1,height,width),
+                            min_bands+max_bands,
+                            window=Window(pos_x,0,width,height))
+
+                print('Min/max found for the strip at ',pos_x)
+
+        # As in climatology_store, the store only takes its name when whole
+        os.replace(store_file+'.tmp',store_file)
+
+        print(len(self.timesteps),' timesteps have been written to tif')
+
+        self.save_contributors({timestep:sorted(set(file_year(file) for file
+                                                   in self.dekad_files[timestep]))
+                                for timestep in self.timesteps})
+
+
+    def load_contributors(self,exclude=()):
+        """Years that went into the min/max of each timestep.
+
+        Min/max tifs made before the years were recorded are taken to hold
+        every year of the baseline, apart from the files in exclude.
+        """
+
+        if os.path.exists(self.contributors_file):
+            with open(self.contributors_file) as record:
+                return {timestep:set(years)
+                        for timestep,years in json.load(record).items()}
+
+        exclude = set(exclude)
+        return {timestep:set(file_year(file) for file in files
+                             if file not in exclude)
+                for timestep,files in self.dekad_files.items()}
+
+
+    def save_contributors(self,contributors):
+        with open(self.contributors_file,'w') as record:
+            json.dump({timestep:sorted(years)
+                       for timestep,years in sorted(contributors.items())},
+                      record,indent=1)
+
+
+    def update(self,new_files,mode='frozen',window=None):
+        """Update the min/max of the dekads of some new files in place.
+
+        Only the Min_/Max_ tifs of the dekads of the new files are opened and
+        only the tiles whose values change are written. Files of a year that
+        is already in the min/max of their dekad are skipped, so the same
+        files can be passed more than once.
+
+        Parameters
+        ----------
+        new_files : :obj:`list` of :obj:`str`
+            Paths of the newly smoothed NDVI tifs.
+        mode : str
+            How the climatology moves on as new years come in:
+
+            - 'frozen' only adds years inside the baseline, so the min/max
+              stay what a full rebuild over the baseline would give. With no
+              baseline nothing is added.
+            - 'extend' adds every new year.
+            - 'rolling' adds every new year but keeps only the latest window
+              years. When a year drops out the dekad is rebuilt from the files
+              of the years left, as a min/max can't be taken back.
+
+            With extra_statistics the min/max are still folded in place,
+            but the other layers of each dekad updated are found again from
+            all of its files, as the percentiles can't be updated from the
+            layers alone. This reads every file of the dekad.
+        window : int
+            Number of years kept by 'rolling'. Defaults to the length of the
+            baseline, or else the number of years each dekad already has.
+
+        Returns
+        -------
+        int
+            Number of files added to the min/max.
+
         """
-    
-        for self.timestep in self.timesteps:
-            for number,file in enumerate(self.files):
-                date = file.split('\\')[-1].split('.tif')[0][12:]
-                if str(self.timestep) in str(date):
-               
-                    self.NDVI=rasterio.open(file).read(1)
-
-
-                    #self.NDVI = np.ma.array(np.where(self.NDVI <= 0.000001,
-                                                   #  np.nan,self.NDVI))
-                    
-                    if number == 0:
-                        
-                        self.maxes = self.NDVI
-                        self.mins = self.NDVI
-                        
-                    else:
-
-                        self.maxes = np.fmax(self.maxes, self.NDVI)
-                        self.mins = np.fmin(self.mins,self.NDVI)
-                    
-                    print(file.split('\\')[-1],' is done')
-            
-            self.save_file()
-             
-
-                    
+
+        if mode not in ('frozen','extend','rolling'):
+            raise ValueError('Unknown climatology update mode: '+str(mode))
+
+        contributors = self.load_contributors(exclude=new_files)
+
+        new = {}
+        for file in new_files:
+            timestep,year = file_dekad(file),file_year(file)
+            if year in contributors.get(timestep,()):
+                continue
+            if mode == 'frozen' and (self.baseline is None or not
+                                     self.baseline[0] <= year <=
+                                     self.baseline[1]):
+                continue
+            new.setdefault(timestep,[]).append(file)
+
+        os.makedirs(self.output_filepath,exist_ok=True)
+
+        added = 0
+
+        with raster_io.dataset_pool() as pool:
+
+            for timestep,files in sorted(new.items()):
+
+                years = contributors.setdefault(timestep,set())
+                kept = max(len(years),1)
+                years.update(file_year(file) for file in files)
+
+                if mode == 'rolling':
+                    if window is not None:
+                        kept = window
+                    elif self.baseline is not None:
+                        kept = self.baseline[1]-self.baseline[0]+1
+                    dropped = sorted(years)[:max(len(years)-kept,0)]
+                    years.difference_update(dropped)
+                else:
+                    dropped = []
+
+                min_file,max_file = [os.path.join(self.output_filepath,
+                                                  prefix+'_'+timestep+'.tif')
+                                     for prefix in ('Min','Max')]
+
+                dekad_files = sorted(set(file for file in self.archive+
+                                         list(new_files)
+                                         if file_dekad(file) == timestep
+                                         and file_year(file) in years))
+
+                if dropped or not (os.path.exists(min_file) and
+                                   os.path.exists(max_file)):
+                    self.rebuild(dekad_files,timestep,pool)
+                else:
+                    self.fold_in(files,min_file,max_file,pool)
+
+                    if self.extra_statistics:
+                        self.rebuild(dekad_files,timestep,pool,
+                                     STATISTICS[2:])
+
+                added += len(files)
+                print(timestep,' min/max updated with ',len(files),' files')
+
+                self.save_contributors(contributors)
+
+        if len(new) > 0:
+            self.update_store(sorted(new))
+
+        return added
+
+
+    def update_store(self,timesteps):
+        """Copy the Min_/Max_ tifs of some timesteps into the store."""
+
+        store_file = os.path.join(self.output_filepath,'Climatology.tif')
+
+        if not os.path.exists(store_file):
+            climatology_store(self.output_filepath)
+            return
+
+        with open_climatology_store(store_file) as store:
+            for timestep,min_band,max_band in zip(timesteps,
+                                                  *store_bands(timesteps)):
+                for prefix,band in (('Min',min_band),('Max',max_band)):
+                    with rasterio.open(os.path.join(self.output_filepath,
+                                                    prefix+'_'+timestep+
+                                                    '.tif')) as dataset:
+                        write_changed_tiles(store,band,store.read(band),
+                                            dataset.read(1))
+
+
+    def rebuild(self,files,timestep,pool,layers=None):
+        """Write the climatology of one dekad from all of its files.
+
+        Only the given layers, e.g. STATISTICS[2:], are written, every layer
+        found if None.
+        """
+
+        height,width = self.meta_data['height'],self.meta_data['width']
+        pos_x,climatology = strip_statistics([files],0,width,height,pool,
+                                             self.extra_statistics)
+
+        if layers is None:
+            layers = STATISTICS[:len(climatology)]
+
+        with raster_io.tif_writer([os.path.join(self.output_filepath,
+                                                layer+'_'+timestep+'.tif')
+                                   for layer in layers],
+                                  self.meta_data) as writer:
+            writer.write_block(climatology[[STATISTICS.index(layer) for layer
+                                            in layers],0],0,0)
+
+
+    def fold_in(self,files,min_file,max_file,pool):
+        """Fold new files into the min/max tifs of one dekad in place."""
+
+        for path,extreme in ((min_file,np.fmin),(max_file,np.fmax)):
+
+            with rasterio.open(path,'r+') as dataset:
+
+                stored = dataset.read(1)
+                updated = stored.copy()
+
+                for file in files:
+                    extreme(updated,pool.read(file),out=updated)
+
+                write_changed_tiles(dataset,1,stored,updated)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""On-disk data cube holding every dekad of NDVI in one file.
+
+Each stage of the pipeline reads hundreds of full tif images, one per date.
+The smoothing needs the time series of every pixel, which is the worst way
+round to read per-date images. This module keeps the images in a single
+HDF5 dataset of shape (time, y, x) that is chunked in both time and space,
+so a strip of pixel time series and a single date can both be read without
+reading the whole archive. New dekads are appended along the time axis
+without rewriting what is already stored.
+"""
+
+import os
+import h5py as h5
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+import raster_io
+
+
+class NDVI_cube:
+    """Class that stores and reads the NDVI cube.
+
+    The cube is stored as float32, or as int16 scaled by 10000 to halve its
+    size. The fill value of the NDVI tifs is kept as a fill value either way.
+
+    Attributes
+    ----------
+    cube_path : str
+        Path to the HDF5 file that holds the cube.
+    scaled : bool
+        Whether the data is stored as scaled int16 rather than float32. Only
+        used when the cube is created, afterwards it is read from the file.
+    chunks : :obj:`tuple` of :obj:`int`
+        Chunk shape (time, y, x) used when the cube is created.
+    cache_size : int
+        Size in bytes of the HDF5 chunk cache.
+    file : HDF5 datareader
+        The open HDF5 file, opened on first use.
+
+    """
+    fill_value = 1.175494351e-38
+    scaled_fill_value = -32768
+    scale = 10000
+
+    def __init__(self,cube_path,scaled=False,chunks=(4,256,32),
+                 cache_size=256*1024**2):
+        """Initiate the attributes.
+
+        Parameters
+        ----------
+        cube_path : str
+            Path to the HDF5 file that holds, or will hold, the cube.
+        scaled : bool
+            Store the data as int16 scaled by 10000 instead of float32.
+        chunks : :obj:`tuple` of :obj:`int`
+            Chunk shape (time, y, x). The default is as wide as a smoothing
+            strip and a few dekads deep.
+        cache_size : int
+            Size in bytes of the HDF5 chunk cache. Reading one date at a time
+            is fastest when a whole layer of chunks fits in it.
+
+        """
+        self.cube_path = cube_path
+        self.scaled = scaled
+        self.chunks = chunks
+        self.cache_size = cache_size
+        self.file = None
+
+    def __getstate__(self):
+        # The open file can't be sent to another process, each process opens
+        # its own copy.
+        state = self.__dict__.copy()
+        state['file'] = None
+        return state
+
+    def open(self,mode='r'):
+        """Open the HDF5 file, if it is not open already in that mode."""
+        if self.file is not None and (mode == 'r' or self.file.mode == 'r+'):
+            return self.file
+
+        self.close()
+        if mode != 'r':
+            os.makedirs(os.path.dirname(os.path.abspath(self.cube_path)),
+                        exist_ok=True)
+        self.file = h5.File(self.cube_path,mode,rdcc_nbytes=self.cache_size,
+                            rdcc_nslots=100003)
+        return self.file
+
+    def close(self):
+        """Close the HDF5 file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @property
+    def dates(self):
+        """:obj:`NumPy array` of :obj:`int` dates (%Y%m%d) in the cube."""
+        return self.open()['dates'][:]
+
+    @property
+    def meta(self):
+        """Rasterio meta data of a single date of the cube."""
+        attributes = self.open()['NDVI'].attrs
+        return {'driver':'GTiff','dtype':'float32','count':1,
+                'nodata':self.fill_value,
+                'width':int(attributes['width']),
+                'height':int(attributes['height']),
+                'crs':rasterio.crs.CRS.from_wkt(attributes['crs']),
+                'transform':rasterio.Affine(*attributes['transform'])}
+
+    def date_indices(self,dates):
+        """Positions in the cube of the given %Y%m%d dates."""
+        stored = self.dates
+        order = np.argsort(stored)
+        dates = np.array(dates,dtype='int64')
+
+        if len(stored) == 0:
+            if len(dates) != 0:
+                raise KeyError('Dates not in the NDVI cube: '+
+                               str(dates.tolist()))
+            return order
+        positions = np.searchsorted(stored,dates,sorter=order)
+        positions = order[np.minimum(positions,len(order)-1)]
+
+        missing = stored[positions] != dates
+        if np.any(missing):
+            raise KeyError('Dates not in the NDVI cube: '+
+                           str(dates[missing].tolist()))
+        return positions
+
+    def create(self,meta_data):
+        """Create an empty cube for images with the given meta data."""
+        file = self.open('a')
+
+        dtype = 'int16' if self.scaled else 'float32'
+        fill = self.scaled_fill_value if self.scaled else self.fill_value
+
+        NDVI = file.create_dataset('NDVI',
+                                   shape=(0,meta_data['height'],
+                                          meta_data['width']),
+                                   maxshape=(None,meta_data['height'],
+                                             meta_data['width']),
+                                   chunks=(self.chunks[0],
+                                           min(self.chunks[1],
+                                               meta_data['height']),
+                                           min(self.chunks[2],
+                                               meta_data['width'])),
+                                   dtype=dtype,
+                                   fillvalue=fill,compression='lzf')
+        NDVI.attrs['scaled'] = self.scaled
+        NDVI.attrs['width'] = meta_data['width']
+        NDVI.attrs['height'] = meta_data['height']
+        NDVI.attrs['crs'] = meta_data['crs'].to_wkt()
+        NDVI.attrs['transform'] = tuple(meta_data['transform'])[:6]
+
+        file.create_dataset('dates',shape=(0,),maxshape=(None,),dtype='int64')
+
+    def append(self,files,dates,pool=None,grid=None):
+        """Append the images of new dates onto the end of the cube.
+
+        Dates that are already in the cube are skipped, so the whole list of
+        files can be passed every run. The files are read and written one
+        band of chunks at a time, so only a band of each new image is held in
+        memory. The dates list is saved with the data so the cube can always
+        be indexed by date.
+
+        Parameters
+        ----------
+        files : :obj:`list` of :obj:`str`
+            Paths of the tif files, in date order.
+        dates : :obj:`list` of :obj:`int`
+            Date (%Y%m%d) of each file.
+        pool : :obj:`raster_io.dataset_pool`
+            Pool to read the files through. A pool is made if None.
+        grid : :obj:`raster_io.grid_alignment`
+            Where each file sits on the full grid, used for a pool made here.
+            The cube is made on the grid of the pool if it has one.
+
+        Returns
+        -------
+        int
+            Number of dates added.
+
+        """
+        file = self.open('a')
+
+        reader = raster_io.dataset_pool(grid=grid) if pool is None else pool
+
+        if 'NDVI' not in file:
+            if reader.grid is not None:
+                self.create(reader.grid.meta)
+            else:
+                with rasterio.open(files[0]) as dataset:
+                    self.create(dataset.meta)
+
+        stored = set(file['dates'][:].tolist())
+        new = [(file_path,int(date)) for file_path,date in zip(files,dates)
+               if int(date) not in stored]
+
+        if len(new) == 0:
+            if pool is None:
+                reader.close()
+            return 0
+
+        NDVI = file['NDVI']
+        height,width = NDVI.shape[1:]
+        band_height = NDVI.chunks[1]
+
+        # The new dates are added a year at a time so that a band of at most
+        # 36 images is in memory.
+        for batch_start in range(0,len(new),36):
+
+            # The dates are written last, so only the rows that have a date
+            # are complete. Rows left by a run that stopped part way through
+            # a batch are written over.
+            batch = new[batch_start:batch_start+36]
+            start = len(file['dates'])
+            NDVI.resize(start+len(batch),axis=0)
+
+            for pos_y in range(0,height,band_height):
+                rows = min(band_height,height-pos_y)
+                window = Window(0,pos_y,width,rows)
+                band = np.array([reader.read(file_path,window)
+                                 for file_path,date in batch],dtype='float32')
+                NDVI[start:,pos_y:pos_y+rows,:] = self.encode(band)
+
+            file['dates'].resize(start+len(batch),axis=0)
+            file['dates'][start:] = [date for file_path,date in batch]
+            file.flush()
+
+        if pool is None:
+            reader.close()
+
+        print(len(new),' dates added to the NDVI cube')
+        return len(new)
+
+    def encode(self,NDVI):
+        """Convert NDVI to the type stored in the cube."""
+        if not self.open()['NDVI'].attrs['scaled']:
+            return NDVI.astype('float32',copy=False)
+
+        scaled = np.round(NDVI*self.scale)
+        scaled[(NDVI == np.float32(self.fill_value)) | np.isnan(NDVI)] = \
+            self.scaled_fill_value
+        return np.clip(scaled,-32767,32767).astype('int16')
+
+    def decode(self,stored):
+        """Convert data read from the cube back to float32 NDVI."""
+        if stored.dtype != np.int16:
+            return stored
+
+        NDVI = stored.astype('float32')/self.scale
+        NDVI[stored == self.scaled_fill_value] = self.fill_value
+        return NDVI
+
+    def read_window(self,indices,pos_x,pos_y,Window_x_size,Window_y_size):
+        """Read a window of the cube for some of its dates.
+
+        Parameters
+        ----------
+        indices : :obj:`NumPy array` of :obj:`int`
+            Positions of the dates along the time axis, see date_indices.
+        pos_x,pos_y : int
+            Column and row offset of the window.
+        Window_x_size,Window_y_size : int
+            Width and height of the window.
+
+        Returns
+        -------
+        :obj:`3-D NumPy array` of :obj:`float`
+            Array of shape (dates, height, width).
+
+        """
+        NDVI = self.open()['NDVI']
+        indices = np.asarray(indices)
+        rows = slice(pos_y,pos_y+Window_y_size)
+        columns = slice(pos_x,pos_x+Window_x_size)
+
+        # h5py only reads increasing, unique indices and contiguous runs are
+        # much quicker to read as a slice.
+        if len(indices) > 0 and np.all(np.diff(indices) == 1):
+            stored = NDVI[indices[0]:indices[-1]+1,rows,columns]
+        else:
+            unique,inverse = np.unique(indices,return_inverse=True)
+            stored = NDVI[unique.tolist(),rows,columns][inverse]
+
+        return self.decode(stored)
+
+    def read_date(self,date):
+        """Read the whole image of a single %Y%m%d date."""
+        index = self.date_indices([date])[0]
+        return self.decode(self.open()['NDVI'][index])
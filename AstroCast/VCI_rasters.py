@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""VCI and VCI3M of every pixel, written as one tif per date.
+
+The aggregation finds the VCI of the pixels inside the shapes and keeps only
+their means. Here the VCI of every pixel of every date is found once, from the
+smoothed NDVI and the climatology store, and written out as tiled, compressed
+tifs, VCI<date>.tif and optionally VCI3M<date>.tif. These are maps of the whole
+country and are not read by the aggregation.
+
+Pixels under cloud, where the NDVI is the fill value, get no VCI here. The
+aggregation still finds a VCI for them, as the databases always have, so means
+of these rasters over a shape can differ from the database means.
+
+The image is done a strip of columns at a time, every date of the strip at
+once, so only one strip is ever held in memory.
+"""
+
+import os
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+import raster_io
+import NDVI_Normalisation
+import zonal_statistics
+import Aggregate
+
+
+def file_date(file):
+    """Date of a smoothed file in the format %Y%m%d."""
+    return file.split('Smoothed')[-1].split('.tif')[0]
+
+
+def strip_VCI(NDVI,Min,Max):
+    """VCI of a stack of NDVI, NaN where it can't be found.
+
+    A pixel gets a VCI where the range of its dekad is not zero, the VCI is
+    finite and neither it nor the NDVI is the fill value. The zone engine
+    counts the VCI of fill value NDVI, cloud, but a VCI map should not. The
+    rasters are float32, so a VCI too large for float32, which only comes
+    from a range of the order of the fill value, is left out as well.
+
+    Parameters
+    ----------
+    NDVI : :obj:`3-D NumPy array` of :obj:`float`
+        NDVI with shape (dates, height, width).
+    Min,Max : :obj:`3-D NumPy array` of :obj:`float`
+        The min and max of the dekad of each date, the same shape.
+
+    Returns
+    -------
+    :obj:`3-D NumPy array` of :obj:`float`
+        The VCI, float32.
+
+    """
+    VCI,cover = zonal_statistics.pixel_VCI(NDVI,Min,Max)
+    valid = (cover & ~zonal_statistics.close_to_fill(VCI) &
+             ~zonal_statistics.close_to_fill(NDVI) &
+             (np.abs(VCI) <= np.finfo('float32').max))
+
+    return np.where(valid,VCI,np.nan).astype('float32')
+
+
+def read_NDVI(files,pos_x,width,height,pool,cube=None):
+    """Smoothed NDVI of a strip for every file, from the cube if given."""
+    if cube is not None:
+        return cube.read_window(cube.date_indices([int(file_date(file)) for
+                                                   file in files]),
+                                pos_x,0,width,height)
+
+    return np.array([pool.read_window(file,pos_x,0,width,height)
+                     for file in files],dtype='float32')
+
+
+def run_VCI(smoothed_files,first=0,VCI3M=True,
+            output_filepath='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\VCI',
+            cube=None,strip_width=32,dates_per_pass=256):
+    """Write the VCI, and VCI3M, rasters of smoothed NDVI files.
+
+    Parameters
+    ----------
+    smoothed_files : :obj:`list` of :obj:`str`
+        Every smoothed NDVI file, in date order.
+    first : int
+        Index of the first file to write the rasters of, so that only new
+        dates are written when appending. The files before it are only read
+        for the VCI3M of the first few new dates.
+    VCI3M : bool
+        Whether to write the VCI3M rasters as well as the VCI.
+    output_filepath : str
+        Folder the rasters are written to.
+    cube : :obj:`NDVI_cube.NDVI_cube`
+        Optional cube of the smoothed NDVI to read from instead of the tifs.
+    strip_width : int
+        Width of the strips the image is done in, a multiple of 32 fills
+        whole tiles.
+    dates_per_pass : int
+        Most dates written in one pass over the image. The output files of a
+        pass are all open at once, so this keeps them under the open file
+        limit.
+
+    Returns
+    -------
+    :obj:`list` of :obj:`str`
+        The VCI files written.
+
+    """
+    if first >= len(smoothed_files):
+        return []
+
+    if not os.path.exists(output_filepath):
+        os.makedirs(output_filepath)
+
+    # Builds the climatology store from the Min_/Max_ tifs if it isn't there
+    store = rasterio.open(NDVI_Normalisation.climatology_store())
+
+    with rasterio.open(smoothed_files[0]) as dataset:
+        meta_data = dataset.meta.copy()
+    meta_data.update(dtype='float32',nodata=np.nan)
+
+    width,height = meta_data['width'],meta_data['height']
+    blocks = [(pos_x,min(strip_width,width-pos_x))
+              for pos_x in range(0,width,strip_width)]
+
+    VCI_files = []
+
+    with raster_io.dataset_pool() as pool:
+
+        for pass_start in range(first,len(smoothed_files),dates_per_pass):
+
+            files = smoothed_files[pass_start:pass_start+dates_per_pass]
+
+            # The dates before the pass that the VCI3M of its first dates
+            # are found from
+            history = []
+            if VCI3M:
+                history = smoothed_files[max(pass_start-
+                                             Aggregate.VCI3M_WINDOW+1,0):
+                                         pass_start]
+
+            dekads = [NDVI_Normalisation.file_dekad(file) for file in
+                      history+files]
+            unique_dekads = sorted(set(dekads))
+            dekad_index = np.array([unique_dekads.index(dekad) for dekad in
+                                    dekads])
+            mins,maxes = NDVI_Normalisation.store_bands(unique_dekads)
+
+            output_files = [os.path.join(output_filepath,'VCI'+
+                                         file_date(file)+'.tif')
+                            for file in files]
+            VCI3M_files = [os.path.join(output_filepath,'VCI3M'+
+                                        file_date(file)+'.tif')
+                           for file in files] if VCI3M else []
+
+            with raster_io.tif_writer(output_files,meta_data) as writer, \
+                 raster_io.tif_writer(VCI3M_files,meta_data) as VCI3M_writer:
+
+                for pos_x,strip in blocks:
+
+                    window = Window(pos_x,0,strip,height)
+
+                    NDVI = read_NDVI(history+files,pos_x,strip,height,pool,
+                                     cube)
+                    Min = store.read(mins,window=window)[dekad_index]
+                    Max = store.read(maxes,window=window)[dekad_index]
+
+                    VCI = strip_VCI(NDVI,Min,Max)
+
+                    writer.write_block(VCI[len(history):],pos_x,0)
+
+                    if VCI3M:
+                        VCI_3M = Aggregate.rolling_VCI3M(
+                            np.moveaxis(VCI[len(history):],0,-1),
+                            np.moveaxis(VCI[:len(history)],0,-1))
+                        VCI3M_writer.write_block(np.moveaxis(VCI_3M,-1,0),
+                                                 pos_x,0)
+
+            VCI_files += output_files
+
+            print(len(files),' VCI rasters have been written')
+
+    store.close()
+
+    return VCI_files
@@ -4,67 +4,114 @@ Created on Mon May  4 12:36:10 2020
 
 @author: Andrew
 """
+import os
 import rasterio
 import numpy as np
 from glob import glob
 
 
+# Size of the full image, files from 2017 onwards are 13 rows and 10 columns
+# smaller and are padded out to this.
+
+FULL_SIZE = 15910066
+
+PAD_TOP = 7
+PAD_BOTTOM = 6
+PAD_LEFT = 5
+PAD_RIGHT = 5
+
+
+def checked_files(record_file):
+    # Names of the files that have already been checked, these are never
+    # opened again
+
+    if not os.path.exists(record_file):
+        return set()
+
+    with open(record_file) as record:
+        return set(line.strip() for line in record if line.strip())
+
+
+def pad_image(NDVI):
+    # Pad the image with the fill value in one allocation rather than copying
+    # the whole image for every row and column inserted
+
+    padded = np.full((NDVI.shape[0]+PAD_TOP+PAD_BOTTOM,
+                      NDVI.shape[1]+PAD_LEFT+PAD_RIGHT),
+                     1.175494351e-38,dtype=NDVI.dtype)
+
+    padded[PAD_TOP:PAD_TOP+NDVI.shape[0],
+           PAD_LEFT:PAD_LEFT+NDVI.shape[1]] = NDVI
+
+    return padded
+
+
+def full_size_meta(files):
+    # Meta data of the first full size file, the grid the padded files are
+    # written on. Only the headers are read, and the pre 2017 files come
+    # first so the search stops at the first file of the archive.
+
+    for file in files:
+        with rasterio.open(file) as dataset:
+            if dataset.width*dataset.height == FULL_SIZE:
+                return dataset.meta.copy()
+
+    return None
+
+
+def change_file_size(new_files,NDVI_filepath,
+                     record_file='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Checked_sizes.txt'):
+
+    # Only files not in the record are looked at and their size is taken from
+    # the header, so the pixels are only read when a file needs padding.
+
+    checked = checked_files(record_file)
+
+    all_files = new_files
+
+    new_files = [file for file in new_files
+                 if file.split('.tif')[0].split('\\')[-1] not in checked]
+
+    if len(new_files) == 0:
+        return
+
+    sizes = {}
 
-def change_file_size(new_files,NDVI_filepath):
-    
-    if len(new_files) != 0:
-        meta_data = rasterio.open(new_files[0]).meta.copy()
-        
     for file in new_files:
-        
-        if int(file.split('.tif')[0].split('dekadal.')[-1][0:4]) >= 2017:
-        
+        with rasterio.open(file) as dataset:
+            sizes[file] = dataset.width*dataset.height
+
+    meta_data = None
+
+    with open(record_file,'a') as record:
+
+        for file in new_files:
+
             name = file.split('.tif')[0].split('\\')[-1]
-            
-            NDVI = rasterio.open(file).read(1)
-            print(name,file)
-            if NDVI.size != 15910066:
-            
-                for x in range(7):
-                     NDVI = np.insert(NDVI,0,
-                                           1.175494351e-38, axis=0)
-                    
-                for x in range(6):
-                     NDVI = np.insert(NDVI,
-                                           len(NDVI[:,0]),
-                                           1.175494351e-38, axis=0)
-                    
-                for y in range(5):
-                     NDVI = np.insert(NDVI,0, 1.175494351e-38, 
-                                           axis=1)
-                    
-                for y in range(5):
-                     NDVI = np.insert( NDVI,
-                                           len(NDVI[0,:]),
-                                           1.175494351e-38, axis=1)    
-                
-            
+
+            if int(file.split('.tif')[0].split('dekadal.')[-1][0:4]) >= 2017 \
+               and sizes[file] != FULL_SIZE:
+
+                print(name,file)
+
+                with rasterio.open(file) as dataset:
+                    NDVI = pad_image(dataset.read(1))
+
+                # The grid is copied from a full size file. Appending usually
+                # only gives new files, all of them cropped, so the archive
+                # is searched for one as well.
+
+                if meta_data is None:
+                    meta_data = full_size_meta(
+                        all_files+sorted(glob(NDVI_filepath+'\\*.tif')))
+
+                if meta_data is None:
+                    raise ValueError('No full size NDVI file to take the grid '
+                                     'of '+name+' from')
+
                 with rasterio.open((NDVI_filepath+'\\'+name
                                    +'.tif'), "w",**meta_data)\
                                    as dest:
                  dest.write(NDVI,1)
-                
-            
-            
-
-        
-
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
\ No newline at end of file
+
+            record.write(name+'\n')
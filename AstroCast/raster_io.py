@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""Shared helpers for reading the NDVI rasters.
+
+The smoothing reads the same few hundred files once for every strip of the
+image. Opening a file and parsing its header each time costs as much as the
+read itself, so the datasets are kept open in a pool for the whole run.
+
+The NDVI files from 2017 onwards are a few rows and columns smaller than the
+rest. Rather than rewriting them, grid_alignment records where each file sits
+on the full image grid and the pool pads every read out to that grid.
+
+Every stage that splits the image between worker processes hands its results
+back through bounded_map, so only a few finished strips are held at once.
+"""
+
+import json
+import os
+from collections import deque
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+import fix_size
+
+
+class grid_alignment:
+    """Registry of where each NDVI file sits on the full image grid.
+
+    The grid is taken from the first file of the full image size. The offset
+    of every other file is found from its transform. Files that are exactly
+    the padding of fix_size smaller but claim the same origin as the full grid
+    are placed where fix_size would have padded them to, so the result matches
+    what fix_size writes. The registry is saved as json so the headers are
+    only looked at once.
+
+    Attributes
+    ----------
+    registry_file : str
+        Path to the json file the registry is kept in.
+    full_size : int
+        Number of pixels in an image of the full grid.
+    reference : dict
+        Width, height, crs, transform, dtype and nodata of the full grid.
+    extents : :obj:`dict` of :obj:`list` of :obj:`int`
+        Column offset, row offset, width and height of each file on the grid,
+        keyed by file name.
+
+    """
+    fill_value = 1.175494351e-38
+
+    def __init__(self,registry_file,full_size=fix_size.FULL_SIZE):
+        """Initiate the attributes, loading the registry if it exists.
+
+        Parameters
+        ----------
+        registry_file : str
+            Path to the json file the registry is kept in.
+        full_size : int
+            Number of pixels in an image of the full grid.
+
+        """
+        self.registry_file = registry_file
+        self.full_size = full_size
+        self.reference = None
+        self.extents = {}
+
+        if os.path.exists(registry_file):
+            with open(registry_file) as registry:
+                saved = json.load(registry)
+            self.reference = saved['reference']
+            self.extents = saved['files']
+
+    @property
+    def width(self):
+        return self.reference['width']
+
+    @property
+    def height(self):
+        return self.reference['height']
+
+    @property
+    def meta(self):
+        """Rasterio meta data of an image on the full grid."""
+        return {'driver':'GTiff','count':1,
+                'dtype':self.reference['dtype'],
+                'nodata':self.reference['nodata'],
+                'width':self.width,'height':self.height,
+                'crs':rasterio.crs.CRS.from_wkt(self.reference['crs']),
+                'transform':rasterio.Affine(*self.reference['transform'])}
+
+    def register(self,files):
+        """Find the place on the grid of any files not in the registry.
+
+        Parameters
+        ----------
+        files : :obj:`list` of :obj:`str`
+            Paths of the tif files.
+
+        Returns
+        -------
+        int
+            Number of files added to the registry.
+
+        """
+        headers = []
+        for file in files:
+            if os.path.basename(file) in self.extents:
+                continue
+            with rasterio.open(file) as dataset:
+                headers.append((os.path.basename(file),dataset.meta.copy()))
+
+        if self.reference is None:
+            for name,meta_data in headers:
+                if meta_data['width']*meta_data['height'] == self.full_size:
+                    self.reference = {'width':meta_data['width'],
+                                      'height':meta_data['height'],
+                                      'crs':meta_data['crs'].to_wkt(),
+                                      'transform':
+                                          tuple(meta_data['transform'])[:6],
+                                      'dtype':meta_data['dtype'],
+                                      'nodata':meta_data['nodata']}
+                    break
+
+        if self.reference is None and len(headers) > 0:
+            raise ValueError('None of the files is the full image size of '+
+                             str(self.full_size)+' pixels')
+
+        grid = rasterio.Affine(*self.reference['transform'])
+
+        for name,meta_data in headers:
+            transform = meta_data['transform']
+            pos_x = int(round((transform.c-grid.c)/grid.a))
+            pos_y = int(round((transform.f-grid.f)/grid.e))
+
+            if (pos_x,pos_y) == (0,0) and \
+               meta_data['width'] == self.width-fix_size.PAD_LEFT-\
+                   fix_size.PAD_RIGHT and \
+               meta_data['height'] == self.height-fix_size.PAD_TOP-\
+                   fix_size.PAD_BOTTOM:
+                pos_x,pos_y = fix_size.PAD_LEFT,fix_size.PAD_TOP
+
+            self.extents[name] = [pos_x,pos_y,meta_data['width'],
+                                  meta_data['height']]
+
+        return len(headers)
+
+    def extent(self,file):
+        """Column offset, row offset, width and height of a file on the grid.
+
+        A file that is not in the registry is added to it, but the registry
+        is not saved.
+        """
+        if os.path.basename(file) not in self.extents:
+            self.register([file])
+        return self.extents[os.path.basename(file)]
+
+    def save(self):
+        """Write the registry to its json file."""
+        with open(self.registry_file,'w') as registry:
+            json.dump({'reference':self.reference,'files':self.extents},
+                      registry)
+
+
+class dataset_pool:
+    """Pool of open rasterio datasets shared by every read of a run.
+
+    At most max_open datasets are kept open. The strips read the files in the
+    same order every time, so evicting the least recently used file would
+    close each file just before it is needed again. Instead the first max_open
+    files stay open for the whole run and any file past that is opened, read
+    and closed straight away.
+
+    With a grid_alignment, windows are given on the full image grid and the
+    parts of a window that a smaller file does not cover are filled with the
+    fill value.
+
+    Attributes
+    ----------
+    max_open : int
+        Maximum number of datasets kept open at once.
+    grid : :obj:`grid_alignment`
+        Where each file sits on the full grid, or None to read the files as
+        they are.
+    datasets : :obj:`dict` of :obj:`rasterio dataset`
+        The open datasets keyed by their file path.
+
+    """
+    def __init__(self,max_open=256,grid=None):
+        """Initiate the attributes.
+
+        Parameters
+        ----------
+        max_open : int
+            Maximum number of datasets kept open at once. This needs to stay
+            below the open file limit of the machine.
+        grid : :obj:`grid_alignment`
+            Where each file sits on the full grid, or None to read the files
+            as they are.
+
+        """
+        self.max_open = max_open
+        self.grid = grid
+        self.datasets = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    def read(self,file,window=None):
+        """Read band 1 of a file, optionally just a window of it.
+
+        Parameters
+        ----------
+        file : str
+            Path to the tif file.
+        window : :obj:`rasterio Window`
+            Part of the image to read. The whole image is read if None.
+            With a grid the window is on the full grid.
+
+        Returns
+        -------
+        :obj:`2-D NumPy array` of :obj:`float`
+            The data read from the file.
+
+        """
+        if self.grid is not None:
+            return self.read_aligned(file,window)
+
+        return self.read_file(file,window)
+
+    def read_file(self,file,window=None):
+        """Read band 1 of a file with the window on the file's own grid."""
+        if file in self.datasets:
+            return self.datasets[file].read(1,window=window)
+
+        if len(self.datasets) < self.max_open:
+            self.datasets[file] = rasterio.open(file)
+            return self.datasets[file].read(1,window=window)
+
+        with rasterio.open(file) as dataset:
+            return dataset.read(1,window=window)
+
+    def read_aligned(self,file,window=None):
+        """Read a window of the full grid from a file that may be smaller."""
+        pos_x,pos_y,width,height = self.grid.extent(file)
+
+        if window is None:
+            window = Window(0,0,self.grid.width,self.grid.height)
+
+        if (pos_x,pos_y,width,height) == (0,0,self.grid.width,
+                                          self.grid.height):
+            return self.read_file(file,window)
+
+        col_off,row_off = int(window.col_off),int(window.row_off)
+        first_column = max(col_off,pos_x)
+        last_column = min(col_off+int(window.width),pos_x+width)
+        first_row = max(row_off,pos_y)
+        last_row = min(row_off+int(window.height),pos_y+height)
+
+        aligned = np.full((int(window.height),int(window.width)),
+                          self.grid.fill_value,
+                          dtype=self.grid.reference['dtype'])
+
+        if first_column < last_column and first_row < last_row:
+            aligned[first_row-row_off:last_row-row_off,
+                    first_column-col_off:last_column-col_off] = \
+                self.read_file(file,Window(first_column-pos_x,first_row-pos_y,
+                                           last_column-first_column,
+                                           last_row-first_row))
+
+        return aligned
+
+    def read_window(self,file,pos_x,pos_y,Window_x_size,Window_y_size):
+        """Same as read but with the window given by its offset and size."""
+        return self.read(file,Window(pos_x,pos_y,Window_x_size,Window_y_size))
+
+    def close(self):
+        """Close every dataset in the pool."""
+        for dataset in self.datasets.values():
+            dataset.close()
+        self.datasets = {}
+
+
+class tif_writer:
+    """Writes a stack of tifs, one per date, a window at a time.
+
+    Every output file is created up front as a tiled, compressed tif and each
+    block of the image is written into its window as soon as it is ready, so
+    the full images never have to be assembled in memory or on disk. The tiles
+    are tile_width columns wide, blocks that start on a multiple of it fill
+    whole tiles and each compressed tile is only written once.
+
+    Attributes
+    ----------
+    datasets : :obj:`list` of :obj:`rasterio dataset`
+        The output datasets opened for writing, in the order of the paths.
+
+    """
+    def __init__(self,paths,meta_data,tile_width=32,tile_height=512):
+        """Create the output files.
+
+        Parameters
+        ----------
+        paths : :obj:`list` of :obj:`str`
+            Path of every output tif.
+        meta_data : dict
+            Rasterio meta data of the images, e.g. from dataset.meta.
+        tile_width : int
+            Width of the tiles, must be a multiple of 16.
+        tile_height : int
+            Height of the tiles, must be a multiple of 16.
+
+        """
+        profile = meta_data.copy()
+        profile.update(driver='GTiff',count=1,tiled=True,
+                       blockxsize=tile_width,blockysize=tile_height,
+                       compress='deflate')
+
+        self.datasets = []
+        try:
+            for path in paths:
+                self.datasets.append(rasterio.open(path,'w',**profile))
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    def write_block(self,stack,pos_x,pos_y):
+        """Write one block of every output.
+
+        Parameters
+        ----------
+        stack : :obj:`3-D NumPy array` of :obj:`float`
+            Block of data with shape (outputs, height, width), the first axis
+            follows the order of the output paths.
+        pos_x : int
+            Column offset of the block.
+        pos_y : int
+            Row offset of the block.
+
+        """
+        window = Window(pos_x,pos_y,stack.shape[2],stack.shape[1])
+
+        for dataset,block in zip(self.datasets,stack):
+            dataset.write(block.astype(dataset.dtypes[0],copy=False),1,
+                          window=window)
+
+    def close(self):
+        """Close the outputs, which flushes any tiles still cached."""
+        for dataset in self.datasets:
+            dataset.close()
+        self.datasets = []
+
+
+def open_file_limit():
+    """Most files this process may have open, or None if there is no limit.
+
+    Where the soft limit is below the hard one, as with the 1024 of many
+    Linux installs, it is first raised as far as it is allowed to go. On
+    Windows, which has no resource module, None is returned.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    soft,hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or
+                                           soft < hard):
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE,(hard,hard))
+            soft = hard
+        except (ValueError,OSError):
+            pass
+
+    return None if soft == resource.RLIM_INFINITY else soft
+
+
+def bounded_map(executor,function,arguments,workers):
+    """Yield the results of function for each set of arguments, in order.
+
+    The calls run in executor, but no more than two calls per worker are in
+    flight at once, so finished results do not pile up in memory while an
+    earlier one is still running.
+
+    Parameters
+    ----------
+    executor : :obj:`concurrent.futures.Executor`
+        Pool the calls are run in.
+    function : callable
+        Function to call, it must be picklable for a process pool.
+    arguments : iterable of :obj:`tuple`
+        Positional arguments of each call. It is only read as calls are
+        submitted.
+    workers : int
+        Number of workers of the executor.
+
+    """
+    pending = deque()
+
+    for args in arguments:
+        pending.append(executor.submit(function,*args))
+
+        if len(pending) >= 2*workers:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
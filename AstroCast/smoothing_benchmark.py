@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the Whittaker smoothing on synthetic NDVI.
+
+Builds a synthetic NDVI archive with a known seasonal signal, cloud dropouts,
+spikes and no data pixels, then times each stage of whittaker_smoothing on
+it: the per-pixel whitsm, the batched whitsm_batch, smooth_all, smooth_new
+and run_smoothing end to end on tif files. For each stage the throughput in
+pixels per second, the peak memory of the process so far and the error
+against a reference solution are reported.
+
+Run it from this folder, for example
+
+    python smoothing_benchmark.py --dates 600 --height 400 --width 128
+
+The same seed always gives the same archive, so results from before and
+after a change can be compared directly.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+import scipy.sparse.linalg
+from rasterio.transform import from_origin
+
+import whittaker_smoothing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+fill_value = np.float32(1.175494351e-38)
+
+
+def synthetic_archive(dates,height,width,seed=0,dropout_rate=0.05,
+                      spike_rate=0.02,no_data_fraction=0.1):
+    """Create a synthetic NDVI archive.
+
+    Parameters
+    ----------
+    dates,height,width : int
+        Shape of the archive, (dates, height, width).
+    seed : int
+        Seed of the random numbers, the same seed gives the same archive.
+    dropout_rate : float
+        Fraction of values that drop to zero, as under cloud.
+    spike_rate : float
+        Fraction of values that jump up by 0.3.
+    no_data_fraction : float
+        Fraction of columns of the image that are fill value throughout, as
+        the sea is.
+
+    Returns
+    -------
+    :obj:`3-D NumPy array` of :obj:`float`
+        The noisy archive, float32.
+    :obj:`3-D NumPy array` of :obj:`float`
+        The clean seasonal signal it was made from.
+
+    """
+    random = np.random.default_rng(seed)
+
+    time_steps = np.arange(dates)[:,None,None]
+    phase = random.uniform(0,2*np.pi,(1,height,width))
+    amplitude = random.uniform(0.1,0.3,(1,height,width))
+    level = random.uniform(0.3,0.5,(1,height,width))
+
+    clean = (level + amplitude*np.sin(2*np.pi*time_steps/36 + phase))
+    clean = clean.astype('float32')
+
+    NDVI = clean + random.normal(0,0.02,clean.shape).astype('float32')
+    NDVI[random.random(NDVI.shape) < dropout_rate] = 0
+    NDVI[random.random(NDVI.shape) < spike_rate] += 0.3
+
+    no_data_columns = int(round(no_data_fraction*width))
+    if no_data_columns > 0:
+        NDVI[:,:,-no_data_columns:] = fill_value
+
+    return NDVI,clean
+
+
+def write_archive(NDVI,folder):
+    """Write the archive as ndvi.dekadal.<date>.tif files, one per dekad."""
+    meta_data = {'driver':'GTiff','dtype':'float32','count':1,
+                 'height':NDVI.shape[1],'width':NDVI.shape[2],
+                 'crs':'EPSG:4326','nodata':float(fill_value),
+                 'transform':from_origin(33.9,5.0,0.0025,0.0025)}
+
+    files = []
+    for counter,image in enumerate(NDVI):
+        year = 2001 + counter//36
+        month = (counter%36)//3 + 1
+        day = [1,11,21][counter%3]
+        file = os.path.join(folder,'ndvi.dekadal.%d%02d%02d.tif'%(year,month,
+                                                                  day))
+        with rasterio.open(file,'w',**meta_data) as dest:
+            dest.write(image,1)
+        files.append(file)
+
+    return files
+
+
+def reference_smoothing(series,lmda=5):
+    """Exact float64 sparse solve of the Whittaker system, one per column."""
+    A = whittaker_smoothing.whittaker_matrix(lmda,len(series)).tocsc()
+    return scipy.sparse.linalg.spsolve(A,np.asarray(series,dtype='d'))
+
+
+def peak_memory():
+    """Peak resident memory of this process and its children in MB."""
+    if resource is None:
+        return None
+
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # Linux reports kB and macOS bytes
+    if os.uname().sysname == 'Darwin':
+        return peak/1024**2
+    return peak/1024
+
+
+def timed(function,*args,**kwargs):
+    """Run a function without its printing and time it."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args,**kwargs)
+        seconds = time.perf_counter() - start
+    return result,seconds
+
+
+def record(results,stage,pixels,seconds,error=None,truth_error=None):
+    results.append({'stage':stage,'pixels':int(pixels),'seconds':seconds,
+                    'pixels_per_second':pixels/seconds if seconds else None,
+                    'peak_memory_MB':peak_memory(),
+                    'max_error_vs_reference':error,
+                    'rms_error_vs_signal':truth_error})
+
+
+def run_benchmark(dates=600,height=200,width=64,seed=0,sample=200,
+                  workers=1,memory_budget=None,new_dates=3):
+    """Time every smoothing stage on one synthetic archive.
+
+    Parameters
+    ----------
+    dates,height,width : int
+        Size of the synthetic archive.
+    seed : int
+        Seed of the synthetic archive.
+    sample : int
+        Number of pixels timed with the per-pixel whitsm, which is slow.
+    workers : int
+        Worker processes used by run_smoothing.
+    memory_budget : int
+        Memory budget in bytes given to run_smoothing.
+    new_dates : int
+        Number of new dates in the smooth_new and append runs.
+
+    Returns
+    -------
+    :obj:`list` of :obj:`dict`
+        One result per stage.
+
+    """
+    results = []
+
+    NDVI,clean = synthetic_archive(dates,height,width,seed)
+
+    valid = whittaker_smoothing.valid_pixels(NDVI)
+    series = whittaker_smoothing.repair_dropouts(NDVI[:,valid].copy())
+    reference = reference_smoothing(series)
+    signal = clean[:,valid]
+
+    # Per-pixel conjugate gradients on a sample of the pixels
+    sample = min(sample,series.shape[1])
+    try:
+        smoothed,seconds = timed(lambda: np.array(
+            [whittaker_smoothing.whitsm(series[:,pixel],5,dates,dates*10)
+             for pixel in range(sample)]).T)
+        record(results,'whitsm',sample,seconds,
+               float(np.abs(smoothed-reference[:,:sample]).max()),
+               float(np.sqrt(np.mean((smoothed-signal[:,:sample])**2))))
+    except TypeError as error:
+        # scipy 1.14 removed the tol argument that whitsm uses
+        print('whitsm could not be run: ',error)
+
+    smoothed,seconds = timed(whittaker_smoothing.whitsm_batch,series,5)
+    record(results,'whitsm_batch',series.shape[1],seconds,
+           float(np.abs(smoothed-reference).max()),
+           float(np.sqrt(np.mean((smoothed-signal)**2))))
+
+    # smooth_all keeps the pre-smoothed part, so only the smoothed part is
+    # compared with the reference
+    split = min(whittaker_smoothing.PRESMOOTHED_LENGTH,dates)
+    start = max(split-whittaker_smoothing.OVERLAP,0)
+    smoothed,seconds = timed(whittaker_smoothing.smooth_all,NDVI.copy(),
+                             width,height)
+    error = None
+    if dates > split:
+        part = whittaker_smoothing.repair_dropouts(NDVI[:,valid].copy()[:split],
+                                                   spikes=False)
+        both = NDVI[:,valid].copy()
+        both[:split] = part
+        whittaker_smoothing.repair_dropouts(both[start:])
+        part_reference = reference_smoothing(both[start:])[split-start:]
+        error = float(np.abs(smoothed[split:][:,valid]-part_reference).max())
+    record(results,'smooth_all',height*width,seconds,error)
+
+    window = NDVI[-36-new_dates:]
+    window_reference = reference_smoothing(
+        whittaker_smoothing.repair_dropouts(window[:,valid].copy()))
+    smoothed,seconds = timed(whittaker_smoothing.smooth_new,window.copy(),
+                             width,height)
+    record(results,'smooth_new',height*width,seconds,
+           float(np.abs(smoothed[:,valid]-window_reference).max()))
+
+    # End to end on tif files, from scratch and appending
+    folder = tempfile.mkdtemp(prefix='smoothing_benchmark_')
+    try:
+        raw_folder = os.path.join(folder,'raw')
+        output_folder = os.path.join(folder,'smoothed')
+        os.makedirs(raw_folder)
+        os.makedirs(output_folder)
+        valid_pixel_file = os.path.join(folder,'Valid_pixels.npy')
+
+        files = write_archive(NDVI,raw_folder)
+
+        result,seconds = timed(whittaker_smoothing.run_smoothing,files,False,0,
+                               workers,memory_budget,output_folder,
+                               valid_pixel_file=valid_pixel_file)
+        with rasterio.open(os.path.join(output_folder,'Smoothed'+
+                           whittaker_smoothing.file_date(files[-1])+
+                           '.tif')) as dataset:
+            last = dataset.read(1)
+        error = None
+        if dates > split:
+            error = float(abs(last[valid]-part_reference[-1]).max())
+        record(results,'run_smoothing',height*width,seconds,error)
+
+        result,seconds = timed(whittaker_smoothing.run_smoothing,
+                               files[-36-new_dates:],True,new_dates,workers,
+                               memory_budget,output_folder,
+                               valid_pixel_file=valid_pixel_file)
+        with rasterio.open(os.path.join(output_folder,'Smoothed'+
+                           whittaker_smoothing.file_date(files[-1])+
+                           '.tif')) as dataset:
+            last = dataset.read(1)
+        record(results,'run_smoothing append',height*width,seconds,
+               float(abs(last[valid]-window_reference[-1]).max()))
+    finally:
+        shutil.rmtree(folder,ignore_errors=True)
+
+    return results
+
+
+def print_results(results):
+    print('%-22s %10s %10s %14s %10s %12s %12s'%('stage','pixels','seconds',
+                                                  'pixels/s','peak MB',
+                                                  'max error','rms signal'))
+    for result in results:
+        print('%-22s %10d %10.3f %14s %10s %12s %12s'%(
+            result['stage'],result['pixels'],result['seconds'],
+            '%.0f'%result['pixels_per_second']
+            if result['pixels_per_second'] else '-',
+            '%.0f'%result['peak_memory_MB']
+            if result['peak_memory_MB'] is not None else '-',
+            '%.2e'%result['max_error_vs_reference']
+            if result['max_error_vs_reference'] is not None else '-',
+            '%.4f'%result['rms_error_vs_signal']
+            if result['rms_error_vs_signal'] is not None else '-'))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dates',type=int,default=600)
+    parser.add_argument('--height',type=int,default=200)
+    parser.add_argument('--width',type=int,default=64)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--sample',type=int,default=200,
+                        help='pixels timed with the per-pixel whitsm')
+    parser.add_argument('--workers',type=int,default=1)
+    parser.add_argument('--memory-budget',type=int,default=None,
+                        help='bytes run_smoothing may use')
+    parser.add_argument('--json',default=None,
+                        help='also write the results to this json file')
+    arguments = parser.parse_args()
+
+    benchmark_results = run_benchmark(arguments.dates,arguments.height,
+                                      arguments.width,arguments.seed,
+                                      arguments.sample,arguments.workers,
+                                      arguments.memory_budget)
+    print_results(benchmark_results)
+
+    if arguments.json is not None:
+        with open(arguments.json,'w') as output:
+            json.dump(benchmark_results,output,indent=2)
@@ -9,242 +9,608 @@ import scipy as sp
 import scipy.sparse
 import scipy.linalg
 from scipy.sparse.linalg import cg
+import functools
 import time
 from datetime import datetime
 import rasterio
 from rasterio.windows import Window
 import os
-import shutil
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+import raster_io
 
 
+# The first 563 dekads of the archive were already smoothed when they were
+# delivered, only the dates after them are smoothed here. The two parts
+# overlap by 10 dekads so the smoothing of the newer part has some history.
+# For an archive shorter than that the whole archive counts as pre-smoothed.
+PRESMOOTHED_LENGTH = 563
+OVERLAP = 10
 
-def whitsm(y, lmda,data_length,maxiter):
 
-  E = sp.sparse.eye(data_length)
+def difference_matrix(data_length):
+
   d1 = -1 * np.ones((data_length),dtype='d')
   d2 = -3 * d1
   d3 =  3 * d1
   d4 = -1 * d1
-  D = sp.sparse.dia_matrix(([d1,d2,d3,d4],[0,1,2,3]), shape=(data_length-3, data_length)).asformat("csr")
+  return sp.sparse.dia_matrix(([d1,d2,d3,d4],[0,1,2,3]), shape=(data_length-3, data_length)).asformat("csr")
+
+
+def whitsm(y, lmda,data_length,maxiter):
+
+  E = sp.sparse.eye(data_length)
+  D = difference_matrix(data_length)
   z = sp.sparse.linalg.cg(E + lmda * (D.transpose()).dot(D), y,tol=3e-2,maxiter = maxiter)
   return z[0]
 
-def write_image(date,NDVI,meta_data):
-    
-    
-    with rasterio.open('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\smoothed_NDVI\\Smoothed'+
-                       str(date)+'.tif', "w",**meta_data)\
-                       as dest:
-                                
-        dest.write(NDVI,indexes=1)
-        print(date, ' Smoothed NDVI Tiff has been created')
-            
+
+@functools.lru_cache(maxsize=8)
+def whittaker_matrix(lmda,data_length):
+  # The sparse system matrix E + lmda*D'D for one series length
+  D = difference_matrix(data_length)
+  return (sp.sparse.eye(data_length) + lmda * (D.transpose()).dot(D)).asformat("csr")
+
+
+@functools.lru_cache(maxsize=8)
+def whittaker_factor(lmda,data_length,dtype='d'):
+  """Banded Cholesky factor of E + lmda*D'D for one series length.
+
+  The system is the same for every pixel with the same number of dates, so
+  it is factored once and reused by every window of the run. The factor is
+  stored in the upper banded form expected by scipy.linalg.cho_solve_banded.
+  It is always computed in float64 and then cast to dtype.
+  """
+  A = whittaker_matrix(lmda,data_length)
+  bands = np.zeros((4,data_length),dtype='d')
+  for k in range(4):
+      bands[3-k,k:] = A.diagonal(k)
+  return scipy.linalg.cholesky_banded(bands,lower=False).astype(dtype)
+
+
+def whitsm_batch(Y, lmda):
+  """Smooth many series at once with the cached banded factor.
+
+  Y has shape (data_length, number of pixels), one series per column, and
+  the smoothed series are returned in the same layout. This gives the exact
+  solution that whitsm approaches iteratively. float32 data is solved in
+  float32, which is plenty for NDVI and halves the memory of the solve.
+  """
+  dtype = 'float32' if Y.dtype == np.float32 else 'd'
+  factor = whittaker_factor(lmda,len(Y),dtype)
+  return scipy.linalg.cho_solve_banded((factor,False),Y)
+
 
 def raw_to_datetime(unformatted_date):
     return datetime.strptime(str(int(unformatted_date)), '%Y%m%d')
 
   
-def read_image(file,pos_x,pos_y,Window_x_size,Window_y_size):
+def file_date(file):
+    return file.split('dekadal.')[1].split('.tif')[0]
+
+  
+def read_image(file,pos_x,pos_y,Window_x_size,Window_y_size,pool=None):
+    
+        # With a pool the dataset stays open for the next strip, otherwise the
+        # file is opened just for this read.
+        if pool is not None:
+            NDVI = pool.read_window(file,pos_x,pos_y,Window_x_size,
+                                    Window_y_size)
+        else:
+            with rasterio.open(file) as dataset:
+                NDVI = dataset.read(1,window = 
+                                    Window(pos_x,pos_y,Window_x_size,
+                                           Window_y_size)) # 1 is the target raster
+        
+        return NDVI,file_date(file)
+    
+def repair_dropouts(NDVI,spikes=True):
     
-        NDVI = rasterio.open(file).read(1,window = 
-                                        Window(pos_x,pos_y,Window_x_size,
-                                               Window_y_size)) # 1 is the target raster
+    # Linearly interpolates over drops to zero and, if spikes is True, over
+    # jumps of 0.2 or more between consecutive dekads. NDVI has shape
+    # (dates, pixels) and is repaired in place.
+    #
+    # The time steps are still walked in order, so a repair changes the
+    # values that the later checks see exactly as the per-pixel loop did, but
+    # every pixel of the window is checked and repaired at once.
+    
+    linear_array = np.array([0,10,20,30])[:,None]
+    
+    for i in range(1,len(NDVI)-2):
+        
+        if spikes:
+            to_repair = (NDVI[i+1] >= NDVI[i] + 0.2) | (NDVI[i] < 0.01)
+        else:
+            to_repair = NDVI[i] < 0.01
+            
+        if not to_repair.any():
+            continue
+            
+        pixels = np.flatnonzero(to_repair)
         
-        date = file.split('dekadal.')[1].split('.tif')[0]
+        y2 = NDVI[i+2,pixels]
+        m = (NDVI[i-1,pixels]-y2)/-30
+        c = y2 - m*30
         
+        NDVI[i-1:i+3,pixels] = (linear_array*m)+c 
         
-        #meta_data = rasterio.open(file).meta.copy()
-        return NDVI,date
+    return NDVI
+
+
+def valid_pixels(smoothing_array):
+    
+    # Pixels that are fill value in more than 400 of the first 563 dates are
+    # no data (sea, outside the country etc.) and are not smoothed. Shorter
+    # archives use the same fraction of their length.
     
-def smooth_all(smoothing_array,Window_x_size,Window_y_size):
+    checked = np.asarray(smoothing_array[:PRESMOOTHED_LENGTH])
+    
+    return (np.count_nonzero(checked==1.175494351e-38,axis=0) <=
+            400*len(checked)/PRESMOOTHED_LENGTH)
+
 
-    smoothing_array = np.array(smoothing_array)
-    linear_array = np.array([0,10,20,30])
+def smooth_all(smoothing_array,Window_x_size,Window_y_size,valid=None):
+
+    smoothing_array = np.asarray(smoothing_array,dtype='float32')
     smoothed_array = np.empty(np.shape(smoothing_array),dtype='float32')    
     
-    new_data_length = len(smoothing_array[553:,0,0])
-    old_data_length = len(smoothing_array[:563,0,0])
+    # Split between the pre-smoothed data and the data smoothed here
+    split = min(PRESMOOTHED_LENGTH,len(smoothing_array))
+    new_start = max(split-OVERLAP,0)
+    
+    new_data_length = len(smoothing_array)-new_start
+    old_data_length = split
     print(new_data_length,old_data_length)
-    maxiter = new_data_length*10
-    fill_array = np.full(len(smoothed_array[:]),1.175494351e-38)
-    
-    for x in range(0,Window_x_size):    
-        for y in range(0,Window_y_size):
-
-            if np.count_nonzero(smoothing_array[:563,y,x]==1.175494351e-38) > 400:
-                smoothed_array[:,y,x] = fill_array
-
-            else:
-                pre_smoothed_NDVI =  smoothing_array[:563,y,x] # This is 2016-08-01
-                 
-                NDVI  =  smoothing_array[553:,y,x]
-                 
-                # Make sure there are no drops to zero in the previous data.
-                # start_overall = time.time()
-                
-                for i in range(1,old_data_length-2):
-                    if pre_smoothed_NDVI[i] < 0.01 :
-                 
-                        y2 = pre_smoothed_NDVI[i+2]
-                        m = (pre_smoothed_NDVI[i-1]-y2)/-30
-                        c = y2 - m*30
-                   
-                        pre_smoothed_NDVI[i-1:i+3] = (linear_array*m)+c 
-                         
-                  
-                for i in range(1,new_data_length-2):
-                    if NDVI[i+1] >= NDVI[i] + 0.2 or NDVI[i] < 0.01 :
-                        y2 = NDVI[i+2]
-                        m = (NDVI[i-1]-y2)/-30
-                        c = y2 - m*30
-                   
-                        NDVI[i-1:i+3] = (linear_array*m)+c 
-                        
-                        
-                # end = time.time()
-                # print(end-start_overall)
-                # start_overall = time.time()
-                newly_smoothed = whitsm(NDVI,5, new_data_length,maxiter)
-                # end = time.time()
-                # print(end-start_overall)
-                smoothed_array[:,y,x] = np.concatenate((pre_smoothed_NDVI, newly_smoothed[10:]))
+    
+    # Pixels that are mostly fill value are not smoothed
+    if valid is None:
+        valid = valid_pixels(smoothing_array)
+    
+    smoothed_array[:,~valid] = 1.175494351e-38
+    
+    NDVI = smoothing_array[:,valid]  # This is 2016-08-01
+    
+    # Make sure there are no drops to zero in the previous data. This runs
+    # first as the two parts overlap.
+    repair_dropouts(NDVI[:split],spikes=False)
+    
+    # The pre-smoothed data is kept as it is, including any repairs made in
+    # the overlap, and only the newer part of each series is smoothed, all
+    # valid pixels in a single banded solve.
+    if len(smoothing_array) > split:
+        
+        repair_dropouts(NDVI[new_start:])
+        
+        newly_smoothed = whitsm_batch(NDVI[new_start:],5)
+        
+        smoothed_array[split:,valid] = newly_smoothed[split-new_start:]
+        
+    smoothed_array[:split,valid] = NDVI[:split]
             
     return smoothed_array
 
 
-def smooth_new(smoothing_array,Window_x_size,Window_y_size):
+def smooth_new(smoothing_array,Window_x_size,Window_y_size,valid=None):
 
-    smoothing_array = np.array(smoothing_array)
-    linear_array = np.array([0,10,20,30])
+    smoothing_array = np.asarray(smoothing_array,dtype='float32')
     smoothed_array = np.empty(np.shape(smoothing_array),dtype='float32')    
     
-    new_data_length = len(smoothing_array)
+    if valid is None:
+        valid = valid_pixels(smoothing_array)
+    
+    smoothed_array[:,~valid] = 1.175494351e-38
+    
+    NDVI = repair_dropouts(smoothing_array[:,valid])
+    
+    # Solve every valid pixel of the window in one multi right-hand-side call
+    smoothed_array[:,valid] = whitsm_batch(NDVI,5)
+            
+    return smoothed_array
 
+
+def depth_of_change(smoothed_array,previous_smoothed,tolerance=1e-3,valid=None):
+    
+    # For append runs. The first dates of smoothed_array were smoothed in an
+    # earlier run as well and previous_smoothed holds that result. Returns,
+    # for each pixel, how many dekads before the new data its smoothed values
+    # moved by more than tolerance. 0 means only the new dates changed.
     
-    maxiter = new_data_length*10
+    history = len(previous_smoothed)
+    depth = np.zeros(np.shape(smoothed_array)[1:],dtype='int16')
     
-    fill_array = np.full(len(smoothed_array[:]),1.175494351e-38)
+    if valid is None:
+        valid = valid_pixels(smoothed_array)
     
+    changed = (np.abs(smoothed_array[:history,valid]-
+                      np.asarray(previous_smoothed)[:,valid]) > tolerance)
     
-    for x in range(0,Window_x_size):    
-        for y in range(0,Window_y_size):
+    first_changed = np.where(changed.any(axis=0),changed.argmax(axis=0),
+                             history)
+    
+    depth[valid] = history - first_changed
+    
+    return depth
 
-            if np.count_nonzero(smoothing_array[:,y,x]==1.175494351e-38) > 400:
-                smoothed_array[:,y,x] = fill_array
 
-            else:
-                 
-                NDVI  =  smoothing_array[:,y,x]
-                 
-                # start_overall = time.time()
-                
-                for i in range(1,new_data_length-2):
-                    if NDVI[i+1] >= NDVI[i] + 0.2 or NDVI[i] < 0.01 :
-                        y2 = NDVI[i+2]
-                        m = (NDVI[i-1]-y2)/-30
-                        c = y2 - m*30
-                   
-                        NDVI[i-1:i+3] = (linear_array*m)+c 
-                        
-                # end = time.time()
-                # print(end-start_overall)
-                # start_overall = time.time()
-                newly_smoothed = whitsm(NDVI,5, new_data_length,maxiter)
-                # end = time.time()
-                # print(end-start_overall)
-                smoothed_array[:,y,x] = newly_smoothed
-        print(x,' done')
-            
-    return smoothed_array
+def plan_blocks(total_width,Window_x_size):
+    
+    # Column blocks (start, width) covering the whole image. The last block is
+    # narrower if the width does not divide evenly.
+    return [(pos_x,min(Window_x_size,total_width-pos_x))
+            for pos_x in range(0,total_width,Window_x_size)]
+
 
+def physical_memory():
+    
+    # Total memory of the machine in bytes, or None if it can't be found.
+    
+    try:
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError,ValueError,OSError):
+        pass
+    
+    try:
+        import ctypes
+        
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength',ctypes.c_ulong),
+                        ('dwMemoryLoad',ctypes.c_ulong),
+                        ('ullTotalPhys',ctypes.c_ulonglong),
+                        ('ullAvailPhys',ctypes.c_ulonglong),
+                        ('ullTotalPageFile',ctypes.c_ulonglong),
+                        ('ullAvailPageFile',ctypes.c_ulonglong),
+                        ('ullTotalVirtual',ctypes.c_ulonglong),
+                        ('ullAvailVirtual',ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual',ctypes.c_ulonglong)]
+            
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+        return status.ullTotalPhys
+    except (AttributeError,OSError):
+        return None
 
 
-def create_tif(dates,Window_x_size,Window_y_size,meta_data,offset):
+def block_width_for_memory(number_of_files,Window_y_size,total_width,
+                           memory_budget,workers=1,previous_dates=0):
+    
+    # Widest block that lets the whole run fit in memory_budget bytes.
+    #
+    # Every column of a block needs, per date and pixel, 4 bytes each for
+    # the raw data, the valid pixels picked out of it, the solved series and
+    # the smoothed output, all float32. On top of that each worker has up to
+    # two more finished or prefetched strips waiting, another 8 bytes.
+    # Incremental runs also read the previous_dates smoothed in the last run,
+    # 4 bytes each, and compare them with the new smoothing, 4 bytes more.
+    #
+    # Blocks are never so wide that some workers would sit idle, and where
+    # possible the width is a multiple of the 32 column output tiles so
+    # blocks fill whole tiles.
+    
+    bytes_per_column = (number_of_files*(4*4+8)+previous_dates*8)*Window_y_size
     
-    for data_no,date in enumerate(dates):
+    workers = max(workers,1)
+    
+    Window_x_size = max(1,int(memory_budget//(bytes_per_column*workers)))
+    
+    Window_x_size = min(Window_x_size,-(-total_width//workers))
+    
+    if Window_x_size >= 32:
+        Window_x_size -= Window_x_size%32
         
-        actual_data_no = offset+data_no
-        TIFF_NDVI = np.empty((Window_y_size,Window_x_size*157),dtype='float32')
+    return Window_x_size
+
+
+def read_strip(files,pos_x,Window_x_size,Window_y_size,pool,cube=None,
+               previous_files=None,valid=None):
+    
+    # Returns the dates, the data to smooth and, for incremental runs, the
+    # previously smoothed data of the strip (None otherwise). If the valid
+    # pixels of the strip are known and there are none, nothing is read and
+    # the data is None.
+    
+    previous_smoothed = None
+    
+    if valid is not None and not valid.any():
+        return [file_date(file) for file in files],None,None
+    
+    if previous_files is not None:
+        previous_smoothed = np.array([pool.read_window(file,pos_x,0,
+                                                       Window_x_size,
+                                                       Window_y_size)
+                                      for file in previous_files],
+                                     dtype='float32')
+    
+    # With a cube the strip comes straight from it as a single read of the
+    # pixel time series.
+    if cube is not None:
+        dates = [file_date(file) for file in files]
         
-        for strip in range(0,157):
-            TIFF_NDVI[:Window_y_size,(strip)*Window_x_size:
-                      (strip+1)*(Window_x_size)] =  np.load('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\file_dump\\Strip'+str(strip)+
-                            'Day'+str(actual_data_no)+'.npy')
+        smoothing_array = cube.read_window(cube.date_indices(dates),pos_x,0,
+                                           Window_x_size,Window_y_size)
         
-        write_image(date,TIFF_NDVI,meta_data)
+        print(len(files),' dates read from the cube for the strip at ',pos_x)
         
+        return dates,smoothing_array,previous_smoothed
+    
+    # Array to store the data read in, float32 so it is not promoted
+    dates = []
+    smoothing_array = np.empty((len(files),Window_y_size,Window_x_size),
+                               dtype='float32')
+    
+    # Open the data from the files and store in the array so pixel wise
+    # smoothing can be performed.
+
+    for counter,file in enumerate(files):
+        NDVI,date = read_image(file,pos_x,0,Window_x_size,Window_y_size,pool)
+        dates.append(date)
+        smoothing_array[counter] = NDVI
+     
+    print(len(files),' files read for the strip at ',pos_x)
+    
+    return dates,smoothing_array,previous_smoothed
+
+
+def smooth_window(smoothing_array,Window_x_size,Window_y_size,end_only,
+                  previous_smoothed=None,valid=None,data_length=None):
+    
+    # Returns the smoothed window, how far back each pixel changed for
+    # incremental runs (None otherwise) and the valid pixels of the window.
+    # A window with no data to smooth is returned as fill value.
+    
+    if smoothing_array is None:
+        return (np.full((data_length,Window_y_size,Window_x_size),
+                        1.175494351e-38,dtype='float32'),None,valid)
+    
+    if valid is None:
+        valid = valid_pixels(smoothing_array)
+    
+    if end_only:
+        smoothed_array = smooth_new(smoothing_array,Window_x_size,
+                                    Window_y_size,valid)
         
+        if previous_smoothed is not None:
+            return (smoothed_array,depth_of_change(smoothed_array,
+                                                   previous_smoothed,
+                                                   valid=valid),valid)
         
+        return smoothed_array,None,valid
         
-def run_smoothing(files,end_only,amount_of_new_files):
+    else:
+        # Perform the pixel-wise smoothing
+        return (smooth_all(smoothing_array,Window_x_size,Window_y_size,valid),
+                None,valid)
+    
+    
+def strip_mask(valid_mask,pos_x,Window_x_size):
+    
+    # The part of the valid pixel mask covering one strip, if there is a mask
+    
+    if valid_mask is None:
+        return None
+    
+    return valid_mask[:,pos_x:pos_x+Window_x_size]
+    
+
+# Each worker process keeps its own pool so a file is opened once per worker
+# rather than once per strip.
+worker_pool = None
 
-    meta_data = rasterio.open(files[0]).meta.copy()
+
+def start_worker(max_open,grid=None):
     
+    global worker_pool
+    worker_pool = raster_io.dataset_pool(max_open,grid)
+
+
+def smooth_strip(files,pos_x,Window_x_size,Window_y_size,end_only,cube=None,
+                 previous_files=None,valid=None):
     
-    # Set window size
+    dates,smoothing_array,previous_smoothed = read_strip(files,pos_x,
+                                                         Window_x_size,
+                                                         Window_y_size,
+                                                         worker_pool,cube,
+                                                         previous_files,valid)
     
-    Window_x_size = 23
-    Window_y_size = 4406
+    return (dates,)+smooth_window(smoothing_array,Window_x_size,Window_y_size,
+                                  end_only,previous_smoothed,valid,len(files))
+        
+        
+def smoothed_strips(files,blocks,Window_y_size,end_only,workers,max_open=256,
+                    cube=None,previous_files=None,valid_mask=None,grid=None):
     
-    start =time.time()
-    for overall_counter,pos_x in enumerate(range(0,3611,23)):
+    # Yields the dates, smoothed strip, change depth (None unless the run is
+    # incremental) and valid pixels of each strip in block order. valid_mask
+    # is the valid pixel mask of the whole image, if it is known. With a
+    # raster_io.grid_alignment the files are read aligned to the full grid.
+    #
+    # On a single core the next strip is read on a background thread while the
+    # current one is smoothed, GDAL releases the GIL while reading so the two
+    # overlap. With more than one worker the strips are smoothed in a process
+    # pool and handed back in order by raster_io.bounded_map.
     
-            # Empty lists to store the data read in
-            dates = []
-            smoothing_array =[] 
+    if workers <= 1:
+        with raster_io.dataset_pool(max_open,grid) as pool, \
+             ThreadPoolExecutor(max_workers=1) as reader:
+            
+            next_strip = reader.submit(read_strip,files,blocks[0][0],
+                                       blocks[0][1],Window_y_size,pool,cube,
+                                       previous_files,
+                                       strip_mask(valid_mask,*blocks[0]))
             
-            # Open the data from the files and store in lists so pixel wise smoothing can
-            # be performed.
-        
-            for counter,file in enumerate(files):
-                NDVI,date = read_image(file,pos_x,0,Window_x_size,Window_y_size)
-                dates.append(date)
-                smoothing_array.append(NDVI)
-             
-                print(counter,' out of ', len(files),' read')
-                        
-
-            if end_only:
-                Smoothed_NDVI = smooth_new(smoothing_array,Window_x_size,
-                                           Window_y_size)
+            for counter,(pos_x,width) in enumerate(blocks):
                 
+                dates,smoothing_array,previous_smoothed = next_strip.result()
                 
-            else:
-                # Perform the pixel-wise smoothing
-                Smoothed_NDVI = smooth_all(smoothing_array,Window_x_size,
-                                           Window_y_size)
-
-            
-            for i in range(0,len(Smoothed_NDVI[:,0,0])):
-                np.save('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\file_dump\\Strip'+str(overall_counter)+'Day'+str(i)+'.npy',Smoothed_NDVI[i,:,:])
-            
-            print(overall_counter,' out of 157 has been done')
+                if counter+1 < len(blocks):
+                    next_strip = reader.submit(read_strip,files,
+                                               blocks[counter+1][0],
+                                               blocks[counter+1][1],
+                                               Window_y_size,pool,cube,
+                                               previous_files,
+                                               strip_mask(valid_mask,
+                                                          *blocks[counter+1]))
+                
+                yield (dates,)+smooth_window(smoothing_array,width,
+                                             Window_y_size,end_only,
+                                             previous_smoothed,
+                                             strip_mask(valid_mask,pos_x,
+                                                        width),
+                                             len(files))
+        return
     
-    if end_only:
+    with ProcessPoolExecutor(max_workers=workers,initializer=start_worker,
+                             initargs=(max_open,grid)) as executor:
+        
+        yield from raster_io.bounded_map(
+            executor,smooth_strip,
+            ((files,pos_x,width,Window_y_size,end_only,cube,previous_files,
+              strip_mask(valid_mask,pos_x,width))
+             for pos_x,width in blocks),workers)
         
-        offset = len(files) - amount_of_new_files
         
-        create_tif(dates[-amount_of_new_files:],Window_x_size,Window_y_size,
-                   meta_data,offset)
+def run_smoothing(files,end_only,amount_of_new_files,workers=1,
+                  memory_budget=None,
+                  output_filepath='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\smoothed_NDVI',
+                  cube=None,previous_smoothed_files=None,
+                  change_depth_filepath='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Change_depth',
+                  valid_pixel_file='C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\Valid_pixels.npy',
+                  grid=None):
+    
+    # workers sets how many processes smooth strips in parallel. The strips
+    # are made as wide as memory_budget, the bytes the whole run may use,
+    # allows. With no budget half of the machine's memory is used. If an
+    # NDVI_cube holding the dates of the files is given the data is read from
+    # it instead of from the files.
+    #
+    # When appending, previous_smoothed_files can be given the smoothed tifs
+    # of the dates before the new ones. The new smoothing is compared with
+    # them and a Change_depth<date>.tif is written showing, for each pixel,
+    # how many dekads before the new data the smoothed values moved. The old
+    # smoothed tifs themselves are left as they are.
+    #
+    # valid_pixel_file holds the mask of pixels that have data. It is made by
+    # the first run from scratch and then used by every run after, so the sea
+    # and other no data pixels are never looked at again and strips without
+    # any valid pixels are not even read. Delete the file to rebuild it.
+    #
+    # grid is a raster_io.grid_alignment. With it, files that are smaller than
+    # the full image are read as if they had been padded out to it and the
+    # outputs are always on the full grid.
+
+    if grid is not None:
+        meta_data = grid.meta
+    else:
+        with rasterio.open(files[0]) as dataset:
+            meta_data = dataset.meta.copy()
+    
+    
+    # Set window size from the size of the images and the memory available.
+    # If the memory can't be found, 32 columns, one output tile, is used.
+    
+    Window_y_size = meta_data['height']
+    total_width = meta_data['width']
+    
+    incremental = end_only and previous_smoothed_files is not None
+    
+    if memory_budget is None and physical_memory() is not None:
+        memory_budget = physical_memory()//2
+    
+    if memory_budget is None:
+        Window_x_size = 32
+    else:
+        Window_x_size = block_width_for_memory(
+            len(files),Window_y_size,total_width,memory_budget,workers,
+            len(previous_smoothed_files) if incremental else 0)
+    
+    print('Smoothing in strips of ',Window_x_size,' columns')
+    
+    blocks = plan_blocks(total_width,Window_x_size)
+    
+    # Only the new dates are written when appending, the rest of the files are
+    # there to give the smoothing some history.
+    if end_only:
+        first_output = len(files) - amount_of_new_files
     else:
-        create_tif(dates,Window_x_size,Window_y_size,meta_data,0)
+        first_output = 0
+    
+    output_files = [os.path.join(output_filepath,'Smoothed'+file_date(file)+'.tif')
+                    for file in files[first_output:]]
+    
+    depth_files = []
+    
+    if incremental:
+        os.makedirs(change_depth_filepath,exist_ok=True)
+        depth_files = [os.path.join(change_depth_filepath,'Change_depth'+
+                                    file_date(files[-1])+'.tif')]
+        
+    valid_mask = None
+    
+    if os.path.exists(valid_pixel_file):
+        valid_mask = np.load(valid_pixel_file)
+        print(np.count_nonzero(valid_mask),' valid pixels loaded')
+        
+    # Only a run over the whole archive can tell which pixels have data
+    build_mask = valid_mask is None and not end_only
+    
+    if build_mask:
+        new_valid_mask = np.zeros((Window_y_size,total_width),dtype=bool)
+        
+    depth_meta = meta_data.copy()
+    depth_meta.update(dtype='int16',nodata=None)
+    
+    # Every output tif is open for the whole run. On a single core the inputs
+    # are kept open in this process too, so the pool is made small enough
+    # that both fit under the open file limit, with some files to spare for
+    # everything else. Worker processes have their own limit.
+    max_open = 256
+    file_limit = raster_io.open_file_limit()
+    
+    if workers <= 1 and file_limit is not None:
+        max_open = max(1,min(max_open,file_limit-len(output_files)-
+                             len(depth_files)-64))
+    
+    start =time.time()
     
+    deepest_change = 0
+    
+    # Each strip goes straight into its window of every output tif.
+    with raster_io.tif_writer(output_files,meta_data) as writer, \
+         raster_io.tif_writer(depth_files,depth_meta) as depth_writer:
+        
+        for overall_counter,((pos_x,width),
+                             (dates,Smoothed_NDVI,change_depth,valid)) \
+                in enumerate(zip(blocks,smoothed_strips(
+                    files,blocks,Window_y_size,end_only,workers,max_open,
+                    cube=cube,
+                    previous_files=previous_smoothed_files if incremental
+                    else None,valid_mask=valid_mask,grid=grid))):
             
-    overall_end = time.time()
-    print(overall_end-start)
+            writer.write_block(Smoothed_NDVI[first_output:],pos_x,0)
+            
+            if incremental:
+                if change_depth is None:
+                    change_depth = np.zeros((Window_y_size,width),dtype='int16')
+                depth_writer.write_block(change_depth[None],pos_x,0)
+                deepest_change = max(deepest_change,int(change_depth.max()))
+                
+            if build_mask:
+                new_valid_mask[:,pos_x:pos_x+width] = valid
+            
+            print(overall_counter,' out of ',len(blocks),' has been done')
+    
+    print(len(output_files),' Smoothed NDVI Tiffs have been created')
     
-    shutil.rmtree('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\file_dump')
+    if build_mask:
+        np.save(valid_pixel_file,new_valid_mask)
+        print(np.count_nonzero(new_valid_mask),' valid pixels saved')
     
-    os.mkdir('C:\\Rangeland\\image_data\\Andrew\\RCMRD Pipeline\\Data\\file_dump')
+    if incremental:
+        print('Smoothed values changed up to ',deepest_change,
+              ' dekads before the new data')
+            
+    overall_end = time.time()
+    print(overall_end-start)
 
     
 
 #shape of files = (4406,3611)
-
-
-
-
-
-
-
-
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""Zonal statistics of the NDVI grid for every shape of a shapefile at once.
+
+Cropping each date to each shape with rasterio.mask rasterizes every polygon
+again for every date. Here each polygon is rasterized once, onto the grid of
+the NDVI, and kept as the list of pixels it covers. The statistics of every
+zone for a date are then a gather of those pixels and a few np.bincount sums.
+A pixel can be in the list of more than one zone, so shapes that overlap are
+handled the same as they are by cropping each one.
+
+Rasterizing a large shapefile is still slow, so the engine can be kept in a
+cache file. The cache is keyed on a hash of the shapefile and on the grid it
+was rasterized onto, and is made again whenever either of them changes.
+"""
+
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+from rasterio.mask import raster_geometry_mask
+
+import NDVI_Normalisation
+
+
+fill_value = 1.175494351e-38
+
+
+def close_to_fill(values):
+    """Values np.ma.masked_values would mask as the fill value."""
+    return np.abs(values-fill_value) <= 1e-8+1e-5*fill_value
+
+
+def pixel_VCI(NDVI,Min,Max):
+    """VCI of each pixel and whether one could be found for it.
+
+    The difference is taken in the precision of the data and the rest in
+    float64, as the masked array arithmetic of cropping each shape does.
+    Masked array division masks a zero range and results that aren't finite,
+    so no VCI is found for those pixels.
+
+    Returns
+    -------
+    :obj:`NumPy array` of :obj:`float`
+        The VCI, float64.
+    :obj:`NumPy array` of :obj:`bool`
+        Whether a VCI could be found for each pixel.
+
+    """
+    with np.errstate(divide='ignore',invalid='ignore',over='ignore'):
+        VCI = 100*(NDVI-Min).astype('float64')/(Max-Min)
+
+    return VCI,(Max-Min != 0) & np.isfinite(VCI)
+
+
+SUM_NAMES = ['NDVI_sum','NDVI_count','NDVI_cover','VCI_sum','VCI_count',
+             'VCI_cover']
+
+
+def means_from_sums(sums,window_counts):
+    """Mean NDVI and VCI of zones from their sums, NaN where under cloud.
+
+    As with cropping each shape, a zone is taken to be under cloud if less
+    than 1% of the pixels of its window have NDVI, and likewise if less
+    than 1% of the pixels that could have a VCI do.
+
+    Parameters
+    ----------
+    sums : dict
+        The sums and counts of each zone, see zone_engine.zone_sums. These
+        may have more axes after the zones, such as the dates.
+    window_counts : :obj:`NumPy array` of :obj:`int`
+        Number of pixels in the window of each zone.
+
+    Returns
+    -------
+    :obj:`NumPy array` of :obj:`float`
+        Mean NDVI of each zone.
+    :obj:`NumPy array` of :obj:`float`
+        Mean VCI of each zone.
+
+    """
+    window_counts = np.reshape(window_counts,np.shape(window_counts)+
+                               (1,)*(np.ndim(sums['NDVI_sum'])-
+                                     np.ndim(window_counts)))
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        NDVI = sums['NDVI_sum']/sums['NDVI_count']
+        VCI = sums['VCI_sum']/sums['VCI_count']
+
+    NDVI[sums['NDVI_cover'] < window_counts/100] = np.nan
+    VCI[sums['VCI_count'] < sums['VCI_cover']/100] = np.nan
+
+    return NDVI,VCI
+
+
+def shapefile_hash(shapefile_path):
+    """SHA-256 of the files that make up a shapefile."""
+    digest = hashlib.sha256()
+    stem = os.path.splitext(shapefile_path)[0]
+
+    for extension in ['.shp','.shx','.dbf','.prj','.cpg']:
+        if not os.path.exists(stem+extension):
+            continue
+        digest.update(extension.encode())
+        with open(stem+extension,'rb') as part:
+            for chunk in iter(lambda: part.read(2**20),b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def grid_key(dataset):
+    """The transform, size and crs of the grid of a dataset as a string."""
+    return json.dumps({'transform':list(dataset.transform)[:6],
+                       'shape':[dataset.height,dataset.width],
+                       'crs':dataset.crs.to_wkt() if dataset.crs else None})
+
+
+class zone_engine:
+    """Pixels of every zone of a shapefile on the NDVI grid.
+
+    Attributes
+    ----------
+    shape : :obj:`tuple` of :obj:`int`
+        Height and width of the grid.
+    windows : :obj:`2-D NumPy array` of :obj:`int`
+        Row offset, column offset, height and width of the window rasterio.mask
+        crops each zone to.
+    pixel_offsets : :obj:`NumPy array` of :obj:`int`
+        Where the pixels of each zone start in pixels, the pixels of zone i
+        are pixels[pixel_offsets[i]:pixel_offsets[i+1]].
+    pixels : :obj:`NumPy array` of :obj:`int`
+        Flat index into the grid of the pixels inside each zone.
+    labels : :obj:`NumPy array` of :obj:`int`
+        Zone of each entry of pixels.
+
+    """
+    def __init__(self,shape,windows,pixel_offsets,pixels):
+        """Initiate the attributes, see from_geometries to make an engine."""
+        self.shape = tuple(shape)
+        self.windows = np.asarray(windows,dtype='int64').reshape(-1,4)
+        self.pixel_offsets = np.asarray(pixel_offsets,dtype='int64')
+        self.pixels = np.asarray(pixels,dtype='int64')
+        self.labels = np.repeat(np.arange(len(self.windows)),
+                                np.diff(self.pixel_offsets))
+
+    @classmethod
+    def from_geometries(cls,geometries,dataset):
+        """Rasterize each zone onto the grid of a dataset.
+
+        Parameters
+        ----------
+        geometries : :obj:`list` of :obj:`list` of :obj:`dict`
+            The GeoJSON geometries of each zone, in the crs of the dataset.
+        dataset : :obj:`rasterio dataset`
+            Any dataset on the NDVI grid.
+
+        Returns
+        -------
+        :obj:`zone_engine`
+            The engine for the zones.
+
+        """
+        windows = []
+        pixels = []
+
+        for features in geometries:
+
+            # The same window and pixels as rasterio.mask crops to
+            outside,transform,window = raster_geometry_mask(dataset,features,
+                                                            crop=True)
+            rows,columns = np.nonzero(~outside)
+            row_off,col_off = int(window.row_off),int(window.col_off)
+
+            windows.append((row_off,col_off,outside.shape[0],
+                            outside.shape[1]))
+            pixels.append((rows+row_off)*dataset.width+columns+col_off)
+
+        pixel_offsets = np.concatenate([[0],np.cumsum([len(zone) for zone in
+                                                       pixels])])
+
+        return cls((dataset.height,dataset.width),windows,pixel_offsets,
+                   np.concatenate(pixels) if pixels else [])
+
+    @classmethod
+    def cached(cls,cache_file,shapefile_path,dataset,geometries):
+        """Load the engine of a shapefile from its cache, or make and save it.
+
+        Parameters
+        ----------
+        cache_file : str
+            Path to the .npz file the engine is kept in.
+        shapefile_path : str
+            Filepath to the shapefile.
+        dataset : :obj:`rasterio dataset`
+            Any dataset on the NDVI grid.
+        geometries : callable
+            Called with the crs of the dataset to get the geometries of each
+            zone, only when the cache can't be used.
+
+        Returns
+        -------
+        :obj:`zone_engine`
+            The engine for the zones.
+
+        """
+        key = shapefile_hash(shapefile_path)+'|'+grid_key(dataset)
+
+        engine = cls.load(cache_file,key)
+        if engine is None:
+            engine = cls.from_geometries(geometries(dataset.crs),dataset)
+            engine.save(cache_file,key)
+
+        return engine
+
+    @classmethod
+    def load(cls,cache_file,key):
+        """The engine saved in a cache file, None if missing or out of date."""
+        if not os.path.exists(cache_file):
+            return None
+
+        with np.load(cache_file) as cache:
+            if str(cache['key']) != key:
+                return None
+            return cls(cache['shape'],cache['windows'],cache['pixel_offsets'],
+                       cache['pixels'])
+
+    def save(self,cache_file,key):
+        """Save the engine to a cache file under a key."""
+        folder = os.path.dirname(cache_file)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # The grid is far smaller than 2**31 pixels, so the pixels are kept as
+        # int32 to halve the file. The file is written whole before replacing
+        # the old one so an interrupted run never leaves half a cache.
+        pixels = self.pixels
+        if self.shape[0]*self.shape[1] < 2**31:
+            pixels = pixels.astype('int32')
+
+        with open(cache_file+'.tmp','wb') as cache:
+            np.savez(cache,key=np.array(key),shape=np.array(self.shape),
+                     windows=self.windows,pixel_offsets=self.pixel_offsets,
+                     pixels=pixels)
+        os.replace(cache_file+'.tmp',cache_file)
+
+    @classmethod
+    def combine(cls,engines):
+        """One engine with the zones of several engines, one after another.
+
+        The engines must be on the same grid. Zone i of the second engine is
+        zone len(engines[0])+i of the combined engine, and so on.
+        """
+        if any(engine.shape != engines[0].shape for engine in engines):
+            raise ValueError('The zones are not all on the same grid')
+
+        pixel_counts = np.concatenate([np.diff(engine.pixel_offsets) for
+                                       engine in engines])
+
+        return cls(engines[0].shape,
+                   np.concatenate([engine.windows for engine in engines]),
+                   np.concatenate([[0],np.cumsum(pixel_counts)]),
+                   np.concatenate([engine.pixels for engine in engines]))
+
+    def cropped(self):
+        """The engine on the window around all of its zones.
+
+        Returns
+        -------
+        :obj:`tuple` of :obj:`int`
+            Row offset, column offset, height and width of the window on the
+            grid.
+        :obj:`zone_engine`
+            The same zones with the window as their grid.
+
+        """
+        top,left = self.windows[:,0].min(),self.windows[:,1].min()
+        bottom = (self.windows[:,0]+self.windows[:,2]).max()
+        right = (self.windows[:,1]+self.windows[:,3]).max()
+
+        rows,columns = np.divmod(self.pixels,self.shape[1])
+
+        window = (int(top),int(left),int(bottom-top),int(right-left))
+        return window,zone_engine(window[2:],self.windows-[top,left,0,0],
+                                  self.pixel_offsets,
+                                  (rows-top)*(right-left)+columns-left)
+
+    def __len__(self):
+        return len(self.windows)
+
+    @property
+    def window_counts(self):
+        """Number of pixels in the window of each zone."""
+        return self.windows[:,2]*self.windows[:,3]
+
+    def gather(self,image):
+        """Values of an image at the pixels of every zone, one after another."""
+        return np.asarray(image).reshape(-1)[self.pixels]
+
+    def bincount(self,weights=None):
+        """Sum of weights, or number of pixels, over each zone."""
+        return np.bincount(self.labels,weights=weights,minlength=len(self))
+
+    def zone_sums(self,NDVI,Min,Max):
+        """Sums and counts of NDVI and VCI over every zone for one date.
+
+        Parameters
+        ----------
+        NDVI,Min,Max : :obj:`NumPy array` of :obj:`float`
+            The NDVI of the date and the min and max of its dekad, each either
+            a whole image or already gathered.
+
+        Returns
+        -------
+        dict
+            For each zone: NDVI_sum and NDVI_count, the sum and number of
+            valid NDVI, NDVI_cover, the number of pixels not fill value,
+            VCI_sum and VCI_count, the same for VCI, and VCI_cover, the number
+            of pixels a VCI could be found for.
+
+        """
+        NDVI,Min,Max = [self.gather(values) if np.ndim(values) == 2
+                        else values for values in (NDVI,Min,Max)]
+
+        cover = ~close_to_fill(NDVI)
+        valid = cover & ~np.isnan(NDVI)
+
+        # masked_values then masks VCI equal to the fill value
+        VCI,VCI_cover = pixel_VCI(NDVI,Min,Max)
+        VCI_valid = VCI_cover & ~close_to_fill(VCI)
+
+        return {'NDVI_sum':self.bincount(np.where(valid,NDVI,0)),
+                'NDVI_count':self.bincount(valid),
+                'NDVI_cover':self.bincount(cover),
+                'VCI_sum':self.bincount(np.where(VCI_valid,VCI,0)),
+                'VCI_count':self.bincount(VCI_valid),
+                'VCI_cover':self.bincount(VCI_cover)}
+
+    def zone_means(self,sums):
+        """Mean NDVI and VCI of every zone, NaN where it is under cloud.
+
+        See means_from_sums.
+        """
+        return means_from_sums(sums,self.window_counts)
+
+
+class min_max_cache:
+    """The min and max of each dekad at the pixels of every zone.
+
+    The min and max of a dekad are the same for every year, so they are read
+    from the climatology store and gathered once and then kept. The least
+    recently used dekads are dropped when the cache grows past max_bytes.
+
+    Attributes
+    ----------
+    store : :obj:`rasterio dataset`
+        The open climatology store.
+    zones : :obj:`zone_engine`
+        The zones the min and max are gathered at.
+    max_bytes : int
+        Most memory in bytes the cached min and max may take.
+    entries : :obj:`OrderedDict`
+        The gathered min and max of each cached dekad, least recently used
+        first.
+    nbytes : int
+        Memory in bytes the cached min and max take.
+    reads : int
+        Number of times a dekad has been read from the store.
+
+    """
+    def __init__(self,store,zones,max_bytes=2*1024**3):
+        self.store = store
+        self.zones = zones
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.reads = 0
+
+    def __getitem__(self,dekad):
+        """Gathered min and max of a dekad in the format %m%d, e.g. 0101."""
+        if dekad in self.entries:
+            self.entries.move_to_end(dekad)
+            return self.entries[dekad]
+
+        bands = [band[0] for band in NDVI_Normalisation.store_bands([dekad])]
+        Min,Max = self.store.read(bands)
+        entry = (self.zones.gather(Min),self.zones.gather(Max))
+        self.reads += 1
+
+        size = entry[0].nbytes+entry[1].nbytes
+        if size <= self.max_bytes:
+            while self.nbytes+size > self.max_bytes:
+                dropped = self.entries.popitem(last=False)[1]
+                self.nbytes -= dropped[0].nbytes+dropped[1].nbytes
+            self.entries[dekad] = entry
+            self.nbytes += size
+
+        return entry